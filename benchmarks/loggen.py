@@ -0,0 +1,150 @@
+"""Deterministic generator of synthetic nginx-access-ui.log-YYYYMMDD files.
+
+Run from the project root:
+python -m benchmarks.loggen --lines 1000000 --urls 10000 --error-rate 0.01 DIR
+"""
+import argparse
+import gzip
+import io
+import itertools
+import os
+import random
+from datetime import datetime, timedelta
+
+URL_TEMPLATES = (
+    "/api/v2/banner/{id}",
+    "/api/v2/banner/{id}/statistic/?date_from=2017-06-28&date_to=2017-06-28",
+    "/api/v2/group/{id}/banners",
+    "/api/v2/slot/{id}/groups",
+    "/api/v2/internal/banner/{id}/info",
+    "/api/1/photogenic_banners/list/?server_name=WIN7RB{id}",
+    "/export/appinstall_raw/2017-06-{id}/",
+)
+USER_AGENTS = (
+    "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5",
+    "Python-urllib/2.7",
+    "Configovod",
+    "Slotovod",
+    "python-requests/2.13.0",
+    "-",
+)
+METHODS = ("GET", "GET", "GET", "POST", "PUT")
+STATUSES = (200, 200, 200, 200, 204, 301, 404, 500)
+
+LINE_FORMAT = (
+    '{ip} {user}  - [{time_local}] "{method} {href} HTTP/1.1" {status} {size} '
+    '"-" "{agent}" "-" "{request_id}" "{rb_user}" {request_time:.3f}\n'
+)
+# broken requests are logged by nginx without method and protocol
+ERROR_LINE_FORMAT = (
+    '{ip} -  - [{time_local}] "-" 400 0 "-" "-" "-" "{request_id}" "-" 0.000\n'
+)
+
+
+def get_log_name(file_date, compress=True):
+    return "nginx-access-ui.log-{}{}".format(file_date, ".gz" if compress else "")
+
+
+def make_urls(urls, rng):
+    return [
+        URL_TEMPLATES[i % len(URL_TEMPLATES)].format(id=rng.randrange(10**7))
+        for i in range(urls)
+    ]
+
+
+def iter_log_lines(lines, urls=1000, error_rate=0.0, seed=0, file_date="20170629"):
+    """Yields `lines` log lines. URL popularity follows Zipf's law and
+    response times are log-normal, same seed gives the same log"""
+    rng = random.Random(seed)
+    hrefs = make_urls(urls, rng)
+    cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1, urls + 1)))
+    day_start = datetime.strptime(file_date, "%Y%m%d")
+    # not datetime.timestamp(), which depends on the local timezone
+    day_timestamp = int((day_start - datetime(1970, 1, 1)).total_seconds())
+    seconds_step = 86400.0 / max(lines, 1)
+
+    for i in range(lines):
+        time_local = (day_start + timedelta(seconds=i * seconds_step)).strftime(
+            "%d/%b/%Y:%H:%M:%S +0300"
+        )
+        ip = "1.{}.{}.{}".format(
+            rng.randrange(256), rng.randrange(256), rng.randrange(256)
+        )
+        request_id = "{}-{}-4708-{}".format(
+            day_timestamp + int(i * seconds_step),
+            rng.randrange(10**10),
+            i,
+        )
+
+        if rng.random() < error_rate:
+            yield ERROR_LINE_FORMAT.format(
+                ip=ip, time_local=time_local, request_id=request_id
+            )
+            continue
+
+        yield LINE_FORMAT.format(
+            ip=ip,
+            user=rng.choice(("-", "3b81f63526fa8")),
+            time_local=time_local,
+            method=rng.choice(METHODS),
+            href=rng.choices(hrefs, cum_weights=cum_weights)[0],
+            status=rng.choice(STATUSES),
+            size=rng.randrange(100000),
+            agent=rng.choice(USER_AGENTS),
+            request_id=request_id,
+            rb_user=rng.choice(("-", "dc7161be3")),
+            request_time=rng.lognormvariate(-1.5, 1.0),
+        )
+
+
+def generate_log(
+    log_dir,
+    lines,
+    urls=1000,
+    error_rate=0.0,
+    seed=0,
+    file_date="20170629",
+    compress=True,
+):
+    """Writes the log to log_dir and returns its path"""
+    log_path = os.path.join(log_dir, get_log_name(file_date, compress))
+
+    with open(log_path, "wb") as raw_file:
+        # zero mtime in gzip header keeps the file byte for byte the same
+        binary_file = raw_file
+        if compress:
+            binary_file = gzip.GzipFile(fileobj=raw_file, mode="wb", mtime=0)
+        with io.TextIOWrapper(binary_file) as log_file:
+            log_file.writelines(
+                iter_log_lines(lines, urls, error_rate, seed, file_date)
+            )
+
+    return log_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log_dir", help="Directory to put the log to")
+    parser.add_argument("--lines", type=int, default=100000)
+    parser.add_argument("--urls", type=int, default=1000, help="URL cardinality")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--date", default="20170629", help="YYYYMMDD of the log")
+    parser.add_argument("--plain", action="store_true", help="Don't gzip the log")
+    args = parser.parse_args()
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    log_path = generate_log(
+        args.log_dir,
+        args.lines,
+        args.urls,
+        args.error_rate,
+        args.seed,
+        args.date,
+        not args.plain,
+    )
+    print(log_path)
+
+
+if __name__ == "__main__":
+    main()
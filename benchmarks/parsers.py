@@ -0,0 +1,47 @@
+"""Micro-benchmark of log_analyzer line parsers on the test data.
+
+Run from the project root: python -m benchmarks.parsers
+"""
+import argparse
+import glob
+import gzip
+import time
+
+from src.log_analyzer import PARSERS
+
+TEST_LOGS_GLOB = "tests/data/logs/nginx-access-ui.log-*.gz"
+
+
+def load_lines(logs_glob=TEST_LOGS_GLOB):
+    lines = []
+    for log_path in sorted(glob.glob(logs_glob)):
+        with gzip.open(log_path, mode="rb") as log_file:
+            lines.extend(log_file)
+    return lines
+
+
+def bench_parser(parse_fn, lines, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            parse_fn(line)
+    elapsed = time.perf_counter() - started
+
+    return len(lines) * repeat / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--repeat", type=int, default=20000, help="How many times to parse the data"
+    )
+    args = parser.parse_args()
+
+    lines = load_lines()
+    for name, parse_fn in PARSERS.items():
+        lines_per_sec = bench_parser(parse_fn, lines, args.repeat)
+        print("{:<8} {:>12,.0f} lines/sec".format(name, lines_per_sec))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Throughput and peak memory of log_analyzer pipeline stages on a synthetic log.
+
+Run from the project root: python -m benchmarks.pipeline
+Results are compared with the stored baseline, --save-baseline replaces it.
+Baselines are machine specific, save your own before comparing changes.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.loggen import generate_log
+from src.log_analyzer import (
+    PARSERS,
+    aggregate_records,
+    build_log_report,
+    build_report,
+    config,
+    get_aggregate_factory,
+    get_aggregate_settings,
+    get_log_records,
+    np,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "pipeline.json")
+
+
+def get_backend_configs():
+    backends = {
+        "python-exact": {"QUANTILE_ENGINE": "exact"},
+        "python-histogram": {"QUANTILE_ENGINE": "histogram"},
+    }
+    if np is not None:
+        backends["numpy"] = {"AGGREGATION_BACKEND": "numpy"}
+    return backends
+
+
+def measure(fn, memory=True):
+    """Returns fn() result, wall time and peak of Python allocations in bytes.
+    Time is measured in a separate run, as tracemalloc slows allocations down"""
+    started = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - started
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def get_case_result(lines, log_size, elapsed, peak):
+    return {
+        "seconds": elapsed,
+        "lines_per_sec": lines / elapsed,
+        "mb_per_sec": log_size / 1024.0 / 1024.0 / elapsed,
+        "peak_mb": None if peak is None else peak / 1024.0 / 1024.0,
+    }
+
+
+def run_benchmarks(log_path, lines, workers, memory=True):
+    log_size = os.path.getsize(log_path)
+    results = {}
+
+    for name, parse_fn in PARSERS.items():
+        records, elapsed, peak = measure(
+            lambda: list(get_log_records(log_path, parse_fn)), memory
+        )
+        results["parse/" + name] = get_case_result(lines, log_size, elapsed, peak)
+
+    for name, backend_config in get_backend_configs().items():
+        aggregate_factory = get_aggregate_factory(
+            get_aggregate_settings(dict(config, **backend_config))
+        )
+        aggregate, elapsed, peak = measure(
+            lambda: aggregate_records(records, aggregate_factory), memory
+        )
+        results["aggregate/" + name] = get_case_result(lines, log_size, elapsed, peak)
+
+        _, elapsed, peak = measure(
+            lambda: build_report(aggregate, config["MAX_REPORT_SIZE"]), memory
+        )
+        results["report/" + name] = get_case_result(lines, log_size, elapsed, peak)
+
+    log_info = {"file_date": "20170629", "name": os.path.basename(log_path)}
+    for case_workers in sorted({1, workers}):
+        with tempfile.TemporaryDirectory() as report_dir:
+            run_config = dict(
+                config,
+                LOG_DIR=os.path.dirname(log_path),
+                REPORT_DIR=report_dir,
+                WORKERS=case_workers,
+            )
+
+            def run():
+                stats = build_log_report(log_info, run_config)
+                os.remove(stats["report"])
+
+            # worker processes' memory isn't traced
+            _, elapsed, peak = measure(run, memory and case_workers == 1)
+        results["end-to-end/workers={}".format(case_workers)] = get_case_result(
+            lines, log_size, elapsed, peak
+        )
+
+    return results
+
+
+def load_baseline(baseline_path=BASELINE_PATH):
+    if not os.path.isfile(baseline_path):
+        return None
+
+    with open(baseline_path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(baseline, baseline_path=BASELINE_PATH):
+    os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+    with open(baseline_path, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def compare(results, baseline, tolerance):
+    """Prints results next to the baseline, returns names of regressed cases:
+    slower or using more memory than baseline by more than tolerance"""
+    regressions = []
+    print(
+        "{:<28} {:>12} {:>9} {:>9} {:>9}".format(
+            "case", "lines/sec", "MB/sec", "peak MB", "vs base"
+        )
+    )
+
+    for name, result in results.items():
+        base = (baseline or {}).get(name)
+        change = ""
+        if base:
+            speed = result["lines_per_sec"] / base["lines_per_sec"]
+            change = "{:+.0%}".format(speed - 1)
+            regressed = speed < 1 - tolerance
+            if result["peak_mb"] is not None and base["peak_mb"]:
+                regressed |= result["peak_mb"] > base["peak_mb"] * (1 + tolerance)
+            if regressed:
+                regressions.append(name)
+                change += " !"
+
+        print(
+            "{:<28} {:>12,.0f} {:>9.2f} {:>9} {:>9}".format(
+                name,
+                result["lines_per_sec"],
+                result["mb_per_sec"],
+                "-"
+                if result["peak_mb"] is None
+                else "{:.1f}".format(result["peak_mb"]),
+                change,
+            )
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--urls", type=int, default=5000, help="URL cardinality")
+    parser.add_argument("--error-rate", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    params = {
+        "lines": args.lines,
+        "urls": args.urls,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+    }
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_path = generate_log(log_dir, **params)
+        results = run_benchmarks(log_path, args.lines, args.workers, not args.no_memory)
+
+    baseline = load_baseline(args.baseline)
+    if baseline is not None and baseline["params"] != params:
+        print("Baseline was made with other params, not comparing")
+        baseline = None
+
+    regressions = compare(results, baseline and baseline["results"], args.tolerance)
+
+    if args.save_baseline:
+        save_baseline({"params": params, "results": results}, args.baseline)
+        print("Baseline saved to {}".format(args.baseline))
+    elif regressions:
+        print("Regressed: {}".format(", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
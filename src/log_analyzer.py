@@ -4,29 +4,75 @@ import json
 import re
 import gzip
 import argparse
-import io
-from datetime import datetime
-from collections import defaultdict
+import math
+import struct
+import heapq
+import hashlib
+import itertools
+import operator
+import mmap
+import sys
+import shutil
+import subprocess
+import threading
+import queue
+import time
+import cProfile
+from multiprocessing import Pool
+from functools import partial, lru_cache
+from datetime import datetime, timedelta
+from collections import Counter, defaultdict
 from string import Template
-import statistics
 from copy import deepcopy
+from contextlib import contextmanager
+from array import array
 
+try:
+    import numpy as np
+except ImportError:  # numpy is needed only for the numpy aggregation backend
+    np = None
 
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS isn't reported there
+    resource = None
+
+
+# log names with date, used with fullmatch()
+LOG_NAME_RE = re.compile(r"nginx-access-ui\.log-(?P<date>\d{8})(?:\.gz)?")
+
+# used with match(), so it's anchored at the line start
 LOG_RECORD_RE = re.compile(
-    r"^"
-    r"\S+ "  # remote_addr
-    r"\S+\s+"  # remote_user (note: ends with double space)
-    r"\S+ "  # http_x_real_ip
-    r"\[\S+ \S+\] "  # time_local [datetime tz] i.e. [29/Jun/2017:10:46:03 +0300]
-    r'"\S+ (?P<href>\S+) \S+" '  # request "method href proto" i.e. "GET /api/v2/banner/23815685 HTTP/1.1"
-    r"\d+ "  # status
-    r"\d+ "  # body_bytes_sent
-    r'"\S+" '  # http_referer
-    r'".*" '  # http_user_agent
-    r'"\S+" '  # http_x_forwarded_for
-    r'"\S+" '  # http_X_REQUEST_ID
-    r'"\S+" '  # http_X_RB_USER
-    r"(?P<time>\d+\.\d+)"  # request_time
+    rb"\S+ "  # remote_addr
+    rb"\S+\s+"  # remote_user (note: ends with double space)
+    rb"\S+ "  # http_x_real_ip
+    rb"\[\S+ \S+\] "  # time_local [datetime tz] i.e. [29/Jun/2017:10:46:03 +0300]
+    rb'"\S+ (?P<href>\S+) \S+" '  # request "method href proto" i.e. "GET /api/v2/banner/23815685 HTTP/1.1"
+    rb"\d+ "  # status
+    rb"\d+ "  # body_bytes_sent
+    rb'"\S+" '  # http_referer
+    rb'".*" '  # http_user_agent
+    rb'"\S+" '  # http_x_forwarded_for
+    rb'"\S+" '  # http_X_REQUEST_ID
+    rb'"\S+" '  # http_X_RB_USER
+    rb"(?P<time>\d+\.\d+)"  # request_time
+)
+
+# same line as LOG_RECORD_RE, but every field used in group-by is captured
+LOG_FIELDS_RE = re.compile(
+    rb"\S+ "  # remote_addr
+    rb"\S+\s+"  # remote_user (note: ends with double space)
+    rb"\S+ "  # http_x_real_ip
+    rb"\[(?P<hour>[^:]+:\d\d):\S+ \S+\] "  # time_local, hour is 29/Jun/2017:10
+    rb'"(?P<method>\S+) (?P<href>\S+) \S+" '  # request "method href proto"
+    rb"(?P<status>\d+) "  # status
+    rb"(?P<body_bytes_sent>\d+) "  # body_bytes_sent
+    rb'"\S+" '  # http_referer
+    rb'".*" '  # http_user_agent
+    rb'"\S+" '  # http_x_forwarded_for
+    rb'"\S+" '  # http_X_REQUEST_ID
+    rb'"\S+" '  # http_X_RB_USER
+    rb"(?P<time>\d+\.\d+)"  # request_time
 )
 
 config = {
@@ -34,10 +80,96 @@ config = {
     "LOG_DIR": "nginx_logs",
     "LOG_FILE": "logs/analyzer_logs.txt",
     "ERRORS_LIMIT": 1000,
+    # lines read before the errors limit is checked on the go
+    "ERRORS_WARMUP": 1000,
+    # lines from the log start parsed to check its format before the full parse
+    "FORMAT_PROBE_LINES": 100,
     "MAX_REPORT_SIZE": 10000,
     "REPORT_TEMPLATE_PATH": "templates",
+    "WORKERS": 1,
+    "QUANTILE_ENGINE": "exact",
+    "QUANTILE_ACCURACY": 0.01,
+    "PARSER": "regex",
+    "CHECKPOINT_DIR": None,
+    "BACKFILL": False,
+    "BACKFILL_WORKERS": None,
+    "GZIP_DECOMPRESSOR": "thread",
+    "URL_NORMALIZE": False,
+    "URL_RULES": [
+        # numeric path segments, i.e. /api/v2/banner/23815685
+        [r"/\d+(?=/|$)", "/{id}"],
+    ],
+    "URL_STRIP_QUERY": True,
+    "URL_CACHE_SIZE": 65536,
+    "MAX_URLS": None,
+    "AGGREGATION_BACKEND": "python",
+    "PARSED_CACHE_DIR": None,
+    # file to cache the list of logs in LOG_DIR until the dir changes
+    "LOG_INDEX_PATH": None,
+    # "inline" table or "paged": gzip json pages in report-YYYY.MM.DD.data dir
+    # loaded by a light report page only when they are scrolled to
+    "REPORT_FORMAT": "inline",
+    "REPORT_PAGE_SIZE": 1000,
+    # breakdowns saved to report-YYYY.MM.DD.groups.json, every one is a list
+    # of GROUP_BY_FIELDS, i.e. [["status"], ["method"], ["hour", "status"]]
+    "GROUP_BY": None,
+    "SAVE_AGGREGATES": False,
+    "ROLLUP": None,
+    "FOLLOW": False,
+    # active (not rotated yet) log, LOG_DIR/nginx-access-ui.log by default
+    "FOLLOW_LOG": None,
+    "FOLLOW_POLL_INTERVAL": 1.0,
+    "FOLLOW_BUCKET_SECONDS": 10,
+    "FOLLOW_SNAPSHOT_INTERVAL": 60,
+    # write run stats to report-YYYY.MM.DD.stats.json next to the report
+    "SAVE_STATS": False,
+    # file for cProfile stats of the whole run
+    "PROFILE": None,
 }
 
+# bucket for URLs which don't fit into MAX_URLS
+OTHER_URL = "other"
+# share of MAX_URLS freed for new URLs, when it's reached, by folding URLs
+# with the smallest time_sum into OTHER_URL
+URL_DEMOTE_SHARE = 0.25
+
+# percentiles reported besides the median
+REPORT_PERCENTILES = (90, 95, 99)
+
+# records parsed at once before they are aggregated, so parsing and
+# aggregation are timed apart without a timer call per line
+PARSE_BATCH_SIZE = 4096
+# size of a decompressed gzip piece parsed at once or sent to a worker process
+GZIP_CHUNK_SIZE = 16 * 1024 * 1024
+# how many decompressed pieces may wait for the parser
+GZIP_QUEUE_SIZE = 4
+
+# fields records can be grouped by, body_bytes_sent is summed in every group
+GROUP_BY_FIELDS = ("method", "status", "hour")
+
+# rolling windows kept in follow mode, name and span in seconds
+FOLLOW_WINDOWS = (("1m", 60), ("5m", 300), ("15m", 900))
+# URLs per time bucket in follow mode when MAX_URLS isn't set
+FOLLOW_MAX_URLS = 10000
+FOLLOW_READ_SIZE = 1024 * 1024
+FOLLOW_LOG_NAME = "nginx-access-ui.log"
+FOLLOW_SNAPSHOT_NAME = "live.json"
+
+# bytes before the checkpoint offset which must be the same on the next run
+CHECKPOINT_FINGERPRINT_SIZE = 4096
+
+# defaults of ERRORS_WARMUP and FORMAT_PROBE_LINES
+ERRORS_WARMUP_LINES = 1000
+FORMAT_PROBE_LINES = 100
+# longer lines aren't log records, the format probe reads no more of them
+FORMAT_PROBE_LINE_SIZE = 64 * 1024
+# share of lines which aren't parsed at which the log is taken as one
+# in a wrong format before it's read in full
+WRONG_FORMAT_ERROR_RATE = 0.9
+# shorter than any line LOG_RECORD_RE matches, so a part of a plain log
+# has no more than its size / MIN_LOG_RECORD_SIZE records
+MIN_LOG_RECORD_SIZE = 40
+
 DEFAULT_CONFIG_PATH = "conf/config.json"
 
 
@@ -52,79 +184,1891 @@ def load_conf(conf_path):
 ####################################
 
 
-def create_report(records, max_records):
-    total_records = 0
-    total_time = 0
-    report_lines = []
-    urls_info = defaultdict(list)
+class ExactQuantiles:
+    """Exact quantiles over a histogram of distinct values.
+
+    Memory depends on the number of distinct values (nginx logs response
+    times with millisecond precision), not on the number of samples.
+    """
+
+    __slots__ = ("count", "values")
+
+    def __init__(self):
+        self.count = 0
+        self.values = Counter()
+
+    def add(self, value):
+        self.count += 1
+        self.values[value] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.values.update(other.values)
+
+    def to_dict(self):
+        return {"values": list(self.values.items())}
+
+    def load(self, data):
+        """Merges state saved with to_dict"""
+        for value, count in data["values"]:
+            self.count += count
+            self.values[value] += count
+
+    def quantile(self, q):
+        """Linear interpolation between closest ranks, for q=0.5 it is
+        the same value as statistics.median returns"""
+        if not self.count:
+            return None
+
+        position = q * (self.count - 1)
+        lower_rank = math.floor(position)
+        upper_rank = math.ceil(position)
+        fraction = position - lower_rank
+
+        lower = None
+        seen = 0
+        for value in sorted(self.values):
+            seen += self.values[value]
+            if lower is None and seen > lower_rank:
+                lower = value
+            if seen > upper_rank:
+                return lower * (1 - fraction) + value * fraction
+
+
+class LogHistogramQuantiles:
+    """Quantile sketch over logarithmic buckets.
+
+    Every returned quantile is within `relative_accuracy` of the exact
+    value ExactQuantiles returns. The number of buckets depends only on the range of
+    the values, and two sketches with the same accuracy can be merged.
+    """
+
+    __slots__ = ("relative_accuracy", "gamma_log", "count", "zeros", "buckets")
+
+    def __init__(self, relative_accuracy=0.01):
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.relative_accuracy = relative_accuracy
+        self.gamma_log = math.log(gamma)
+        self.count = 0
+        self.zeros = 0
+        self.buckets = Counter()
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        self.buckets[math.ceil(math.log(value) / self.gamma_log)] += 1
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different accuracy")
+
+        self.count += other.count
+        self.zeros += other.zeros
+        self.buckets.update(other.buckets)
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "zeros": self.zeros,
+            "buckets": list(self.buckets.items()),
+        }
 
-    for href, response_time in records:
-        total_records += 1
-        total_time += response_time
+    def load(self, data):
+        """Merges state saved with to_dict"""
+        if data["relative_accuracy"] != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different accuracy")
+
+        self.count += data["zeros"]
+        self.zeros += data["zeros"]
+        for index, count in data["buckets"]:
+            self.count += count
+            self.buckets[index] += count
+
+    def get_value(self, index):
+        # middle of the bucket (gamma^(i-1), gamma^i] in terms of relative error
+        gamma_power = math.exp(index * self.gamma_log)
+        return 2 * gamma_power / (1 + math.exp(self.gamma_log))
+
+    def quantile(self, q):
+        """Linear interpolation between closest ranks like in ExactQuantiles,
+        ranks' values are taken from their buckets"""
+        if not self.count:
+            return None
+
+        position = q * (self.count - 1)
+        lower_rank = math.floor(position)
+        upper_rank = math.ceil(position)
+        fraction = position - lower_rank
+
+        lower = None
+        seen = self.zeros
+        if seen > lower_rank:
+            lower = 0.0
+        if seen > upper_rank:
+            return 0.0
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if lower is None and seen > lower_rank:
+                lower = self.get_value(index)
+            if seen > upper_rank:
+                return lower * (1 - fraction) + self.get_value(index) * fraction
+
+
+QUANTILE_ENGINES = {
+    "exact": ExactQuantiles,
+    "histogram": LogHistogramQuantiles,
+}
 
-        urls_info[href].append(response_time)
 
-        if total_records == max_records:
-            break
+def get_quantile_factory(engine="exact", accuracy=None):
+    if engine not in QUANTILE_ENGINES:
+        raise ValueError("Unknown quantile engine {}".format(engine))
+
+    if engine == "histogram" and accuracy is not None:
+        return partial(LogHistogramQuantiles, relative_accuracy=accuracy)
+
+    return QUANTILE_ENGINES[engine]
+
+
+class UrlStats:
+    """Streaming accumulator of response times for a single URL"""
+
+    __slots__ = ("count", "time_sum", "time_max", "times")
+
+    def __init__(self, quantile_factory=ExactQuantiles):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.times = quantile_factory()
+
+    def add(self, response_time):
+        self.count += 1
+        self.time_sum += response_time
+        if response_time > self.time_max:
+            self.time_max = response_time
+        self.times.add(response_time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        self.time_max = max(self.time_max, other.time_max)
+        self.times.merge(other.times)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "time_sum": self.time_sum,
+            "time_max": self.time_max,
+            "times": self.times.to_dict(),
+        }
+
+    def load(self, data):
+        """Merges state saved with to_dict"""
+        self.count += data["count"]
+        self.time_sum += data["time_sum"]
+        self.time_max = max(self.time_max, data["time_max"])
+        self.times.load(data["times"])
+
+    def quantile(self, q):
+        return self.times.quantile(q)
+
+    def median(self):
+        return self.times.quantile(0.5)
+
+
+class UrlNormalizer:
+    """Collapses hrefs into route templates.
+
+    Query string is stripped and every (pattern, replacement) rule is applied
+    with re.sub. Results are kept in LRU cache because hrefs repeat a lot.
+    """
+
+    def __init__(self, rules=(), strip_query=True, cache_size=65536):
+        self.rules = [tuple(rule) for rule in rules]
+        self.strip_query = strip_query
+        self.cache_size = cache_size
+        self.compiled_rules = [
+            (re.compile(pattern), replacement) for pattern, replacement in self.rules
+        ]
+        self.cached_normalize = lru_cache(maxsize=cache_size)(self.normalize)
+
+    def normalize(self, href):
+        if self.strip_query:
+            href = href.partition("?")[0]
+        for pattern, replacement in self.compiled_rules:
+            href = pattern.sub(replacement, href)
+        return sys.intern(href)
+
+    def __call__(self, href):
+        return self.cached_normalize(href)
+
+    def __getstate__(self):
+        # the cache is not picklable, workers start with an empty one
+        return self.rules, self.strip_query, self.cache_size
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def get_kept_urls(max_urls):
+    """How many URLs are left besides OTHER_URL when `max_urls` is reached"""
+    return max(0, max_urls - 1 - max(1, int(max_urls * URL_DEMOTE_SHARE)))
+
+
+class LogAggregate:
+    """Per-URL statistics of a log (or of a part of it).
+
+    hrefs are passed through `normalize_url` when it's given. There are no
+    more than `max_urls` URLs, OTHER_URL included: when a new URL comes and
+    there is no room, URLs with the smallest time_sum are folded into
+    OTHER_URL, so it's the long tail which is folded, not URLs which
+    come late.
+    """
+
+    def __init__(
+        self, quantile_factory=ExactQuantiles, normalize_url=None, max_urls=None
+    ):
+        self.quantile_factory = quantile_factory
+        self.normalize_url = normalize_url
+        self.max_urls = max_urls
+        self.urls = {}
+        self.total_records = 0
+        self.total_time = 0.0
+        self.errors = 0
+
+    def get_url_stats(self, href):
+        url_stats = self.urls.get(href)
+        if url_stats is not None:
+            return url_stats
+
+        if self.max_urls is not None and len(self.urls) >= self.max_urls:
+            self.demote_urls(get_kept_urls(self.max_urls))
+            url_stats = self.urls.get(href)
+            # with max_urls of 1 there is room for OTHER_URL only
+            if url_stats is None and len(self.urls) >= self.max_urls:
+                url_stats = self.urls[OTHER_URL]
+            if url_stats is not None:
+                return url_stats
+
+        url_stats = self.urls[href] = UrlStats(self.quantile_factory)
+        return url_stats
+
+    def demote_urls(self, keep):
+        """Folds all but `keep` URLs with the biggest time_sum into OTHER_URL"""
+        other_stats = self.urls.pop(OTHER_URL, None)
+        if other_stats is None:
+            other_stats = UrlStats(self.quantile_factory)
+
+        kept = {
+            href
+            for href, _ in heapq.nlargest(
+                keep, self.urls.items(), key=lambda item: item[1].time_sum
+            )
+        }
+        urls = {}
+        for href, url_stats in self.urls.items():
+            if href in kept:
+                urls[href] = url_stats
+            else:
+                other_stats.merge(url_stats)
+
+        urls[OTHER_URL] = other_stats
+        self.urls = urls
+
+    def trim_urls(self):
+        """Folds the lightest URLs which don't fit into max_urls after merge"""
+        if self.max_urls is not None and len(self.urls) > self.max_urls:
+            self.demote_urls(self.max_urls - 1)
+
+    def add(self, href, response_time):
+        self.total_records += 1
+        self.total_time += response_time
+
+        if self.normalize_url is not None:
+            href = self.normalize_url(href)
+        self.get_url_stats(href).add(response_time)
+
+    def merge(self, other):
+        """Merges aggregate with the same normalization"""
+        self.total_records += other.total_records
+        self.total_time += other.total_time
+        self.errors += other.errors
+
+        # URLs of both are compared before the lightest ones are folded
+        for href, other_stats in other.urls.items():
+            url_stats = self.urls.get(href)
+            if url_stats is None:
+                url_stats = self.urls[href] = UrlStats(self.quantile_factory)
+            url_stats.merge(other_stats)
+        self.trim_urls()
+
+    def to_dict(self):
+        return {
+            "total_records": self.total_records,
+            "total_time": self.total_time,
+            "errors": self.errors,
+            "urls": {href: stats.to_dict() for href, stats in self.urls.items()},
+        }
+
+    def load(self, data):
+        """Merges state saved with to_dict"""
+        self.total_records += data["total_records"]
+        self.total_time += data["total_time"]
+        self.errors += data["errors"]
+
+        for href, stats_data in data["urls"].items():
+            url_stats = self.urls.get(href)
+            if url_stats is None:
+                url_stats = self.urls[href] = UrlStats(self.quantile_factory)
+            url_stats.load(stats_data)
+        self.trim_urls()
+
+
+def get_group_by_fields(group_by):
+    """Fields parsed for `group_by`: every used group-by field once, then
+    body_bytes_sent"""
+    fields = []
+    for group_fields in group_by:
+        for field in group_fields:
+            if field not in GROUP_BY_FIELDS:
+                raise ValueError("Unknown group-by field {}".format(field))
+            if field not in fields:
+                fields.append(field)
+
+    return tuple(fields) + ("body_bytes_sent",)
+
+
+class GroupedLogAggregate(LogAggregate):
+    """LogAggregate which also groups records by other fields of the line,
+    by every group-by of `group_by` at once.
+
+    Records are (href, response_time, fields), fields are values of
+    get_group_by_fields(group_by) in that order. Every group keeps only
+    [count, time_sum, time_max, bytes_sum].
+    """
+
+    def __init__(
+        self,
+        group_by,
+        quantile_factory=ExactQuantiles,
+        normalize_url=None,
+        max_urls=None,
+    ):
+        super().__init__(quantile_factory, normalize_url, max_urls)
+        self.group_by = [tuple(group_fields) for group_fields in group_by]
+        fields = get_group_by_fields(self.group_by)
+        # keys of one field groups are values, not 1-tuples
+        self.key_getters = [
+            operator.itemgetter(*(fields.index(field) for field in group_fields))
+            for group_fields in self.group_by
+        ]
+        self.bytes_index = fields.index("body_bytes_sent")
+        self.groups = [{} for _ in self.group_by]
+
+    def add(self, href, response_time, fields=()):
+        super().add(href, response_time)
+
+        body_bytes_sent = fields[self.bytes_index]
+        for groups, get_key in zip(self.groups, self.key_getters):
+            key = get_key(fields)
+            stats = groups.get(key)
+            if stats is None:
+                groups[key] = [1, response_time, response_time, body_bytes_sent]
+                continue
+
+            stats[0] += 1
+            stats[1] += response_time
+            if response_time > stats[2]:
+                stats[2] = response_time
+            stats[3] += body_bytes_sent
+
+    def merge_group(self, groups, key, other_stats):
+        stats = groups.get(key)
+        if stats is None:
+            groups[key] = list(other_stats)
+            return
+
+        stats[0] += other_stats[0]
+        stats[1] += other_stats[1]
+        stats[2] = max(stats[2], other_stats[2])
+        stats[3] += other_stats[3]
+
+    def merge(self, other):
+        super().merge(other)
+        for groups, other_groups in zip(self.groups, other.groups):
+            for key, other_stats in other_groups.items():
+                self.merge_group(groups, key, other_stats)
+
+    def to_dict(self):
+        data = super().to_dict()
+        data["groups"] = [list(groups.items()) for groups in self.groups]
+        return data
+
+    def load(self, data):
+        super().load(data)
+        for groups, saved_groups in zip(self.groups, data["groups"]):
+            for key, saved_stats in saved_groups:
+                # json turns tuple keys into lists
+                if isinstance(key, list):
+                    key = tuple(key)
+                self.merge_group(groups, key, saved_stats)
+
+
+class UrlSummary:
+    """Read-only per-URL statistics computed by ColumnarAggregate"""
+
+    __slots__ = ("count", "time_sum", "time_max", "quantiles")
+
+    def __init__(self, count, time_sum, time_max, quantiles):
+        self.count = count
+        self.time_sum = time_sum
+        self.time_max = time_max
+        self.quantiles = quantiles
+
+    def quantile(self, q):
+        return self.quantiles[q]
+
+    def median(self):
+        return self.quantiles[0.5]
+
+
+class ColumnarAggregate:
+    """Per-URL statistics of a log computed with NumPy.
+
+    hrefs are stored as integer codes and response times as float64 in flat
+    arrays. Statistics of all URLs are computed at once by sorting the
+    columns and reducing every group of equal codes. Quantiles are exact
+    and have the same values as ExactQuantiles returns.
+
+    Loaded state keeps a row per distinct (href, time) pair, the number of
+    records of every row is in `weights`, which is None while every row is
+    a single record.
+    """
+
+    def __init__(self, normalize_url=None, max_urls=None):
+        if np is None:
+            raise RuntimeError("numpy is required for numpy aggregation backend")
+
+        self.normalize_url = normalize_url
+        self.max_urls = max_urls
+        self.codes = {}
+        self.hrefs = []
+        self.href_codes = array("q")
+        self.times = array("d")
+        self.weights = None
+        self.total_records = 0
+        self.total_time = 0.0
+        self.errors = 0
+        self.summaries = None
+
+    def get_code(self, href):
+        """Code of href, URLs are folded into OTHER_URL like in LogAggregate"""
+        code = self.codes.get(href)
+        if code is not None:
+            return code
+
+        if self.max_urls is not None and len(self.codes) >= self.max_urls:
+            self.demote_urls(get_kept_urls(self.max_urls))
+            code = self.codes.get(href)
+            # with max_urls of 1 there is room for OTHER_URL only
+            if code is None and len(self.codes) >= self.max_urls:
+                code = self.codes[OTHER_URL]
+            if code is not None:
+                return code
+
+        return self.add_code(href)
+
+    def add_code(self, href):
+        code = self.codes[href] = len(self.hrefs)
+        self.hrefs.append(href)
+        return code
+
+    def get_columns(self):
+        """href codes, times and weights of rows as numpy arrays"""
+        codes = np.frombuffer(self.href_codes, dtype=np.int64)
+        times = np.frombuffer(self.times, dtype=np.float64)
+        if self.weights is None:
+            weights = np.ones(len(times), dtype=np.int64)
+        else:
+            weights = np.frombuffer(self.weights, dtype=np.int64)
+        return codes, times, weights
+
+    def demote_urls(self, keep):
+        """Folds all but `keep` URLs with the biggest time_sum into OTHER_URL,
+        href codes are renumbered"""
+        codes, times, weights = self.get_columns()
+        time_sums = np.bincount(
+            codes, weights=times * weights, minlength=len(self.hrefs)
+        )
+
+        kept = set(
+            heapq.nlargest(
+                keep,
+                (href for href in self.hrefs if href != OTHER_URL),
+                key=lambda href: time_sums[self.codes[href]],
+            )
+        )
+        hrefs = [href for href in self.hrefs if href in kept] + [OTHER_URL]
+
+        recode = np.full(len(self.hrefs), len(hrefs) - 1, dtype=np.int64)
+        for code, href in enumerate(hrefs[:-1]):
+            recode[self.codes[href]] = code
+        href_codes = array("q")
+        href_codes.frombytes(recode[codes].tobytes())
+        del codes, times, weights
+
+        self.href_codes = href_codes
+        self.hrefs = hrefs
+        self.codes = {href: code for code, href in enumerate(hrefs)}
+        self.summaries = None
+
+    def trim_urls(self):
+        """Folds the lightest URLs which don't fit into max_urls after merge"""
+        if self.max_urls is not None and len(self.codes) > self.max_urls:
+            self.demote_urls(self.max_urls - 1)
+
+    def add(self, href, response_time):
+        self.total_records += 1
+        self.total_time += response_time
+
+        if self.normalize_url is not None:
+            href = self.normalize_url(href)
+        # get_code may replace href_codes when URLs are folded
+        code = self.get_code(href)
+        self.href_codes.append(code)
+        self.times.append(response_time)
+        if self.weights is not None:
+            self.weights.append(1)
+        self.summaries = None
+
+    def extend(self, hrefs, href_codes, times, weights=None):
+        """Appends columns (any sequences or arrays) which use their own href
+        codes, `weights` are numbers of records of the rows, 1 by default"""
+        if not len(href_codes):
+            return
+
+        if weights is not None or self.weights is not None:
+            if self.weights is None:
+                self.weights = array("q")
+                self.weights.frombytes(np.ones(len(self.times), np.int64).tobytes())
+            if weights is None:
+                weights = np.ones(len(href_codes), dtype=np.int64)
+            self.weights.frombytes(np.asarray(weights, dtype=np.int64).tobytes())
+
+        # URLs of both are compared before the lightest ones are folded
+        recode = np.array(
+            [
+                self.codes[href] if href in self.codes else self.add_code(href)
+                for href in hrefs
+            ],
+            dtype=np.int64,
+        )
+        codes = np.asarray(href_codes, dtype=np.int64)
+        self.href_codes.frombytes(recode[codes].tobytes())
+        self.times.frombytes(np.asarray(times, dtype=np.float64).tobytes())
+        self.summaries = None
+        self.trim_urls()
+
+    def merge(self, other):
+        """Merges aggregate with the same normalization"""
+        self.total_records += other.total_records
+        self.total_time += other.total_time
+        self.errors += other.errors
+        self.extend(other.hrefs, other.href_codes, other.times, other.weights)
+
+    def to_dict(self):
+        """Saves counts of distinct (href, time) pairs, not every record, so
+        like with ExactQuantiles the size depends on the number of distinct
+        response times of URLs, not on the number of requests"""
+        codes, times, weights = self.get_columns()
+
+        order = np.lexsort((times, codes))
+        sorted_codes = codes[order]
+        sorted_times = times[order]
+        sorted_weights = weights[order]
+        # no pair starts in an empty aggregate
+        starts = np.flatnonzero(
+            np.r_[
+                len(sorted_codes) > 0,
+                (sorted_codes[1:] != sorted_codes[:-1])
+                | (sorted_times[1:] != sorted_times[:-1]),
+            ]
+        )
+
+        return {
+            "total_records": self.total_records,
+            "total_time": self.total_time,
+            "errors": self.errors,
+            "hrefs": self.hrefs,
+            "href_codes": sorted_codes[starts].tolist(),
+            "times": sorted_times[starts].tolist(),
+            "counts": (
+                np.add.reduceat(sorted_weights, starts).tolist() if len(starts) else []
+            ),
+        }
+
+    def load(self, data):
+        """Merges state saved with to_dict, pairs are kept with their counts,
+        so memory depends on the number of pairs, not of records"""
+        self.total_records += data["total_records"]
+        self.total_time += data["total_time"]
+        self.errors += data["errors"]
+        self.extend(data["hrefs"], data["href_codes"], data["times"], data["counts"])
+
+    @property
+    def urls(self):
+        """href -> UrlSummary in the order of first appearance"""
+        if self.summaries is None:
+            self.summaries = self.summarize()
+        return self.summaries
+
+    def summarize(self):
+        if not len(self.times):
+            return {}
+
+        codes, times, weights = self.get_columns()
+
+        # times are sorted inside every group of codes
+        order = np.lexsort((times, codes))
+        sorted_codes = codes[order]
+        sorted_times = times[order]
+        sorted_weights = weights[order]
+
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        ends = np.r_[starts[1:], len(sorted_codes)]
+        counts = np.add.reduceat(sorted_weights, starts)
+        sums = np.add.reduceat(sorted_times * sorted_weights, starts)
+        maxes = sorted_times[ends - 1]
+        # a record of rank r of a group is in the first row whose cumulative
+        # weight is over the records before the group plus r
+        cumulative = np.cumsum(sorted_weights)
+        before = cumulative[starts] - sorted_weights[starts]
+
+        quantiles = {}
+        for q in (0.5,) + tuple(p / 100.0 for p in REPORT_PERCENTILES):
+            position = q * (counts - 1)
+            lower_rank = np.floor(position).astype(np.int64)
+            upper_rank = np.ceil(position).astype(np.int64)
+            fraction = position - lower_rank
+            lower = sorted_times[
+                np.searchsorted(cumulative, before + lower_rank, "right")
+            ]
+            upper = sorted_times[
+                np.searchsorted(cumulative, before + upper_rank, "right")
+            ]
+            quantiles[q] = (lower * (1 - fraction) + upper * fraction).tolist()
+
+        summaries = {}
+        for i, code in enumerate(sorted_codes[starts].tolist()):
+            summaries[self.hrefs[code]] = UrlSummary(
+                int(counts[i]),
+                float(sums[i]),
+                float(maxes[i]),
+                {q: values[i] for q, values in quantiles.items()},
+            )
+        return summaries
+
+
+AGGREGATION_BACKENDS = ("python", "numpy")
+
+
+def get_aggregate_settings(config):
+    """Config options which define how aggregates are built"""
+    quantile_engine = config.get("QUANTILE_ENGINE", "exact")
+    url_normalize = bool(config.get("URL_NORMALIZE"))
+
+    return {
+        "backend": config.get("AGGREGATION_BACKEND", "python"),
+        "quantile_engine": quantile_engine,
+        "quantile_accuracy": (
+            config.get("QUANTILE_ACCURACY") if quantile_engine != "exact" else None
+        ),
+        "url_rules": (config.get("URL_RULES") or []) if url_normalize else None,
+        "url_strip_query": config.get("URL_STRIP_QUERY") if url_normalize else None,
+        "url_cache_size": config.get("URL_CACHE_SIZE") if url_normalize else None,
+        "max_urls": config.get("MAX_URLS"),
+        "group_by": config.get("GROUP_BY") or None,
+    }
+
+
+def get_aggregate_factory(settings):
+    backend = settings.get("backend", "python")
+    if backend not in AGGREGATION_BACKENDS:
+        raise ValueError("Unknown aggregation backend {}".format(backend))
+
+    normalize_url = None
+    if settings["url_rules"] is not None:
+        normalize_url = UrlNormalizer(
+            settings["url_rules"],
+            settings["url_strip_query"],
+            settings["url_cache_size"],
+        )
+
+    group_by = settings.get("group_by")
+    if backend == "numpy":
+        if group_by:
+            raise ValueError("Group-by is supported by python backend only")
+
+        return partial(
+            ColumnarAggregate,
+            normalize_url=normalize_url,
+            max_urls=settings["max_urls"],
+        )
+
+    quantile_factory = get_quantile_factory(
+        settings["quantile_engine"], settings["quantile_accuracy"]
+    )
+    if group_by:
+        return partial(
+            GroupedLogAggregate,
+            group_by,
+            quantile_factory=quantile_factory,
+            normalize_url=normalize_url,
+            max_urls=settings["max_urls"],
+        )
+
+    return partial(
+        LogAggregate,
+        quantile_factory=quantile_factory,
+        normalize_url=normalize_url,
+        max_urls=settings["max_urls"],
+    )
+
+
+def aggregate_records(records, aggregate_factory=LogAggregate):
+    aggregate = aggregate_factory()
+
+    for record in records:
+        aggregate.add(*record)
+
+    return aggregate
+
+
+def get_top_urls(aggregate, max_urls=None):
+    """Returns (href, stats) of `max_urls` URLs with the biggest time_sum,
+    sorted by time_sum. Only a heap of `max_urls` items is kept"""
+    items = aggregate.urls.items()
+    if max_urls is None:
+        return sorted(items, key=lambda item: item[1].time_sum, reverse=True)
+
+    return heapq.nlargest(max_urls, items, key=lambda item: item[1].time_sum)
+
 
-    for key, value in urls_info.items():
-        count = len(value)
-        time_sum = sum(value)
+def get_time_perc(time_sum, total_time):
+    """Percent of the total time, 0 when every request took 0.000, i.e.
+    a rolling window of cached hits"""
+    return 100 * time_sum / total_time if total_time else 0.0
+
+
+def build_report(aggregate, max_urls=None):
+    """Report lines of `max_urls` slowest in total URLs, percents are
+    calculated over the whole log"""
+    report_lines = []
+
+    for href, url_stats in get_top_urls(aggregate, max_urls):
         report_line = {
-            "href": key,
-            "count": count,
-            "count_perc": 100 * float(count) / float(len(urls_info.items())),
-            "time_sum": time_sum,
-            "time_perc": 100 * float(time_sum) / float(total_time),
-            "time_avg": statistics.mean(value),
-            "time_max": max(value),
-            "time_med": statistics.median(value),
+            "href": href,
+            "count": url_stats.count,
+            "count_perc": 100 * float(url_stats.count) / aggregate.total_records,
+            "time_sum": url_stats.time_sum,
+            "time_perc": get_time_perc(url_stats.time_sum, aggregate.total_time),
+            "time_avg": url_stats.time_sum / url_stats.count,
+            "time_max": url_stats.time_max,
+            "time_med": url_stats.median(),
         }
+        for percentile in REPORT_PERCENTILES:
+            report_line["time_p{}".format(percentile)] = url_stats.quantile(
+                percentile / 100.0
+            )
 
         report_lines.append(report_line)
 
     return report_lines
 
 
-def get_log_records(log_path, parse_log_record, errors_limit=None):
-    open_fn = gzip.open if is_gzip_file(log_path) else io.open
-    errors = 0
-    records = []
-    with open_fn(log_path, mode="rb") as log_file:
-        for line in log_file:
-            line = line.decode("utf-8")
+def build_group_reports(aggregate):
+    """Report lines of every group-by of GroupedLogAggregate, keyed by joined
+    group-by fields. Lines are sorted by group key"""
+    reports = {}
+
+    for group_fields, groups in zip(aggregate.group_by, aggregate.groups):
+        report_lines = []
+        for key, (count, time_sum, time_max, bytes_sum) in sorted(groups.items()):
+            if len(group_fields) == 1:
+                key = (key,)
+            report_line = dict(zip(group_fields, key))
+            report_line.update(
+                {
+                    "count": count,
+                    "count_perc": 100 * float(count) / aggregate.total_records,
+                    "time_sum": time_sum,
+                    "time_perc": get_time_perc(time_sum, aggregate.total_time),
+                    "time_avg": time_sum / count,
+                    "time_max": time_max,
+                    "bytes_sum": bytes_sum,
+                    "bytes_avg": bytes_sum / count,
+                }
+            )
+            report_lines.append(report_line)
+
+        reports[",".join(group_fields)] = report_lines
+
+    return reports
+
+
+def create_report(records, max_urls):
+    return build_report(aggregate_records(records), max_urls)
+
+
+@contextmanager
+def open_log_buffer(log_path):
+    """Maps plain text log into memory, so lines are parsed in place
+    and only the fields we keep are copied"""
+    with open(log_path, "rb") as log_file:
+        if os.fstat(log_file.fileno()).st_size == 0:
+            yield b""
+            return
+
+        with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+
+def iter_buffer_lines(buf, start=0, end=None):
+    """Yields (start, end) bounds of lines in buf[start:end], including newline"""
+    if end is None:
+        end = len(buf)
+
+    while start < end:
+        newline = buf.find(b"\n", start, end)
+        line_end = end if newline == -1 else newline + 1
+        yield start, line_end
+        start = line_end
+
+
+def iter_log_buffers(log_path, decompressor="inline", timings=None):
+    """Yields buffers of whole lines of the log: decompressed pieces of gzip
+    log or the whole plain text log"""
+    if is_gzip_file(log_path):
+        yield from read_gzip_chunks(log_path, decompressor, timings)
+        return
 
-            parsed_line = parse_log_record(line)
+    with open_log_buffer(log_path) as buf:
+        yield buf
+
+
+def yield_parsed_batch(batch, started, timings):
+    """Yields records of the batch parsed since `started`. Time of parsing
+    and of consumer's work on the records is added to `timings` under
+    "parse" and "aggregate" keys"""
+    parsed = time.perf_counter()
+    timings["parse"] += parsed - started
+    yield from batch
+    timings["aggregate"] += time.perf_counter() - parsed
+
+
+def get_log_records(
+    log_path,
+    parse_log_record,
+    errors_limit=None,
+    decompressor="inline",
+    timings=None,
+    counters=None,
+    errors_warmup=ERRORS_WARMUP_LINES,
+):
+    """Yields parsed records one by one. Errors limit is checked on every error
+    after `errors_warmup` lines (see check_errors_limit_early) and when the
+    file is read, then numbers of records and errors are put to `counters`
+    if it's given. Lines are parsed by PARSE_BATCH_SIZE records, so time of
+    parsing and of aggregation of the records is added to `timings` apart"""
+    if timings is None:
+        timings = defaultdict(float)
+    errors = 0
+    records_count = 0
+    # the rest of a plain log is the rest of its buffer
+    is_plain = not is_gzip_file(log_path)
+    records_left = None
+    for buf in iter_log_buffers(log_path, decompressor, timings):
+        batch = []
+        started = time.perf_counter()
+        for start, end in iter_buffer_lines(buf):
+            parsed_line = parse_log_record(buf, start, end)
             if parsed_line is None:
                 errors += 1
+                if (
+                    errors_limit is not None
+                    and errors + records_count + len(batch) >= errors_warmup
+                ):
+                    if is_plain:
+                        records_left = (len(buf) - end) // MIN_LOG_RECORD_SIZE
+                    check_errors_limit_early(
+                        errors, records_count + len(batch), errors_limit, records_left
+                    )
                 continue
 
-            records.append(parsed_line)
+            batch.append(parsed_line)
+            if len(batch) == PARSE_BATCH_SIZE:
+                records_count += len(batch)
+                yield from yield_parsed_batch(batch, started, timings)
+                batch = []
+                started = time.perf_counter()
 
-    records_count = len(records)
+        records_count += len(batch)
+        yield from yield_parsed_batch(batch, started, timings)
 
-    if (
-        errors_limit is not None
-        and records_count > 0
-        and errors / float(records_count) > errors_limit
-    ):
+    if counters is not None:
+        counters["records"] = records_count
+        counters["errors"] = errors
+
+    check_errors_limit(errors, records_count, errors_limit)
+
+
+def check_errors_limit(errors, records_count, errors_limit):
+    if errors_limit is None or not errors:
+        return
+
+    # a log without a single parsed line is over any limit
+    if not records_count or errors / float(records_count) > errors_limit:
         raise RuntimeError("Errors limit exceeded")
 
-    return records
+
+def check_errors_limit_early(errors, records_count, errors_limit, records_left=None):
+    """Checks the limit before the whole log is read. Errors may bunch up at
+    some part of a good log, so the limit is exceeded only when the rest of
+    the log can't bring errors back under it (`records_left` is the upper
+    bound of records in the rest, when it's known), or when nearly all
+    lines aren't parsed, i.e. the log is in a wrong format"""
+    if records_left is not None:
+        check_errors_limit(errors, records_count + records_left, errors_limit)
+
+    if errors >= WRONG_FORMAT_ERROR_RATE * (errors + records_count):
+        check_errors_limit(errors, records_count, errors_limit)
+
+
+def probe_log_format(
+    log_path, parse_log_record, errors_limit, lines=FORMAT_PROBE_LINES
+):
+    """Parses only the first `lines` lines of the log, so a log in a wrong
+    format fails before it's decompressed and parsed in full. Every
+    FORMAT_PROBE_LINE_SIZE piece of a longer line is counted as an error,
+    so no more than `lines` such pieces are read.
+
+    The log fails when nearly all of the lines aren't parsed, or when it's
+    read in full and is over the errors limit.
+    """
+    if errors_limit is None or not lines:
+        return
+
+    errors = 0
+    records_count = 0
+    read_all = False
+    log_open = gzip.open if is_gzip_file(log_path) else open
+    with log_open(log_path, "rb") as log_file:
+        for _ in range(lines):
+            # a corrupted log may have no newlines at all, i.e. be filled
+            # with zeros, so only a bounded prefix of the line is read
+            line = log_file.readline(FORMAT_PROBE_LINE_SIZE)
+            if not line:
+                read_all = True
+                break
+
+            if (
+                len(line) == FORMAT_PROBE_LINE_SIZE and not line.endswith(b"\n")
+            ) or parse_log_record(line.rstrip(b"\n")) is None:
+                errors += 1
+            else:
+                records_count += 1
+
+    # a few broken lines at the start don't tell much about the whole log
+    if not read_all and errors < WRONG_FORMAT_ERROR_RATE * (errors + records_count):
+        return
+
+    try:
+        check_errors_limit(errors, records_count, errors_limit)
+    except RuntimeError:
+        raise RuntimeError(
+            "Log format isn't recognized: {} of first {} lines aren't parsed".format(
+                errors, errors + records_count
+            )
+        ) from None
+
+
+def decode_href(raw_href):
+    """hrefs repeat a lot, so they are interned to keep one copy of each"""
+    return sys.intern(raw_href.decode("utf-8"))
 
 
-def parse_log_record(log_line):
-    search = re.search(LOG_RECORD_RE, log_line)
+def parse_log_record(log_line, start=0, end=None):
+    """Parses raw bytes line (or log_line[start:end] of a bigger buffer),
+    only href is decoded"""
+    match = LOG_RECORD_RE.match(log_line, start, len(log_line) if end is None else end)
 
-    if not search:
+    if not match:
         return None
 
-    href = search.group(1)
-    request_time = float(search.group(2))
+    href = decode_href(match.group(1))
+    request_time = float(match.group(2))
 
     return href, request_time
 
 
+@lru_cache(maxsize=1024)
+def get_hour_bucket(raw_hour):
+    """29/Jun/2017:03 -> 2017-06-29 03:00, so hours sort by time"""
+    return datetime.strptime(raw_hour.decode("ascii"), "%d/%b/%Y:%H").strftime(
+        "%Y-%m-%d %H:00"
+    )
+
+
+def get_method(match):
+    return sys.intern(match.group("method").decode("ascii", "replace"))
+
+
+def get_status(match):
+    return int(match.group("status"))
+
+
+def get_hour(match):
+    return get_hour_bucket(match.group("hour"))
+
+
+def get_body_bytes_sent(match):
+    return int(match.group("body_bytes_sent"))
+
+
+LOG_FIELD_GETTERS = {
+    "method": get_method,
+    "status": get_status,
+    "hour": get_hour,
+    "body_bytes_sent": get_body_bytes_sent,
+}
+
+
+def parse_log_fields(log_line, start=0, end=None, fields=()):
+    """Parses the line like parse_log_record, returns (href, request_time,
+    values of `fields`)"""
+    match = LOG_FIELDS_RE.match(log_line, start, len(log_line) if end is None else end)
+
+    if not match:
+        return None
+
+    values = tuple(LOG_FIELD_GETTERS[field](match) for field in fields)
+    return decode_href(match.group("href")), float(match.group("time")), values
+
+
+PARSERS = {
+    "regex": parse_log_record,
+}
+
+
+def get_parser(name="regex", group_by=None):
+    """Line parser, group-by needs its fields parsed by parse_log_fields"""
+    if name not in PARSERS:
+        raise ValueError("Unknown parser {}".format(name))
+
+    if group_by:
+        return partial(parse_log_fields, fields=get_group_by_fields(group_by))
+
+    return PARSERS[name]
+
+
+####################################
+# Gzip decompression
+####################################
+
+
+def iter_gzip_blocks_inline(log_path, chunk_size, timings):
+    with gzip.open(log_path, mode="rb") as log_file:
+        while True:
+            started = time.perf_counter()
+            block = log_file.read(chunk_size)
+            timings["decompress"] += time.perf_counter() - started
+            if not block:
+                break
+            yield block
+
+
+def put_until_stopped(blocks, item, stop):
+    """Puts item to the queue unless the reader stops first and leaves the
+    queue full. Returns False when the reader stopped"""
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def decompress_to_queue(log_path, chunk_size, blocks, stop, timings):
+    """Runs in a background thread, zlib releases the GIL while inflating"""
+    try:
+        for block in iter_gzip_blocks_inline(log_path, chunk_size, timings):
+            if not put_until_stopped(blocks, block, stop):
+                return
+        put_until_stopped(blocks, None, stop)
+    except Exception as e:
+        put_until_stopped(blocks, e, stop)
+
+
+def iter_gzip_blocks_thread(log_path, chunk_size, timings):
+    blocks = queue.Queue(maxsize=GZIP_QUEUE_SIZE)
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=decompress_to_queue,
+        args=(log_path, chunk_size, blocks, stop, timings),
+        daemon=True,
+    )
+    thread.start()
+
+    try:
+        while True:
+            block = blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop.set()
+        thread.join()
+
+
+def get_external_decompressor():
+    return shutil.which("pigz") or shutil.which("gzip")
+
+
+def iter_gzip_blocks_external(log_path, chunk_size, timings):
+    """Reads output of pigz or gzip running in a separate process"""
+    command = [get_external_decompressor(), "-dc", log_path]
+    finished = False
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        try:
+            while True:
+                started = time.perf_counter()
+                block = process.stdout.read(chunk_size)
+                timings["decompress"] += time.perf_counter() - started
+                if not block:
+                    break
+                yield block
+            finished = True
+        finally:
+            # the reader may stop early, then the decompressor is not needed
+            if not finished:
+                process.kill()
+
+    if finished and process.returncode != 0:
+        raise RuntimeError("{} failed to decompress {}".format(command[0], log_path))
+
+
+GZIP_DECOMPRESSORS = {
+    "inline": iter_gzip_blocks_inline,
+    "thread": iter_gzip_blocks_thread,
+    "external": iter_gzip_blocks_external,
+}
+
+
+def read_gzip_chunks(
+    log_path, decompressor="inline", timings=None, chunk_size=GZIP_CHUNK_SIZE
+):
+    """Decompresses gzip file into pieces of whole lines.
+
+    `decompressor` is one of GZIP_DECOMPRESSORS, "external" falls back to
+    "thread" when neither pigz nor gzip is installed. Time spent on
+    decompression is added to `timings` under "decompress" key.
+    """
+    if decompressor not in GZIP_DECOMPRESSORS:
+        raise ValueError("Unknown gzip decompressor {}".format(decompressor))
+    if decompressor == "external" and get_external_decompressor() is None:
+        decompressor = "thread"
+    if timings is None:
+        timings = defaultdict(float)
+
+    rest = b""
+    for block in GZIP_DECOMPRESSORS[decompressor](log_path, chunk_size, timings):
+        newline = block.rfind(b"\n")
+        if newline == -1:
+            rest += block
+            continue
+
+        lines_end = newline + 1
+        yield rest + block[:lines_end]
+        rest = block[lines_end:]
+
+    if rest:
+        yield rest
+
+
+####################################
+# Parallel analyzing
+####################################
+
+
+def aggregate_buffer(
+    buf,
+    parse_log_record,
+    aggregate_factory=LogAggregate,
+    start=0,
+    end=None,
+    aggregate=None,
+    errors_limit=None,
+    errors_warmup=ERRORS_WARMUP_LINES,
+    log_size=None,
+    timings=None,
+):
+    """Aggregates lines of buf[start:end] into a new or the given aggregate.
+    With `errors_limit` it's checked on every error after `errors_warmup`
+    lines of the aggregate, see check_errors_limit_early. `log_size` is size
+    of the whole log when buf[start:end] is a range of it, it bounds records
+    of the rest of the log. Time of parsing and of aggregation is added to
+    `timings` like in get_log_records"""
+    if aggregate is None:
+        aggregate = aggregate_factory()
+    if timings is None:
+        timings = defaultdict(float)
+    records_left = None
+
+    batch = []
+    started = time.perf_counter()
+    for line_start, line_end in iter_buffer_lines(buf, start, end):
+        parsed_line = parse_log_record(buf, line_start, line_end)
+        if parsed_line is None:
+            aggregate.errors += 1
+            records_count = aggregate.total_records + len(batch)
+            if (
+                errors_limit is not None
+                and aggregate.errors + records_count >= errors_warmup
+            ):
+                if log_size is not None:
+                    records_left = (
+                        log_size - (line_end - start)
+                    ) // MIN_LOG_RECORD_SIZE
+                check_errors_limit_early(
+                    aggregate.errors, records_count, errors_limit, records_left
+                )
+            continue
+
+        batch.append(parsed_line)
+        if len(batch) == PARSE_BATCH_SIZE:
+            for parsed_line in yield_parsed_batch(batch, started, timings):
+                aggregate.add(*parsed_line)
+            batch = []
+            started = time.perf_counter()
+
+    for parsed_line in yield_parsed_batch(batch, started, timings):
+        aggregate.add(*parsed_line)
+
+    return aggregate
+
+
+def split_file_ranges(log_path, parts, start=0, end=None):
+    """Splits [start, end) range of plain text file into at most `parts`
+    byte ranges aligned on newlines"""
+    if end is None:
+        end = os.path.getsize(log_path)
+    bounds = [start]
+
+    with open(log_path, "rb") as log_file:
+        for i in range(1, parts):
+            log_file.seek(max(start + (end - start) * i // parts, bounds[-1]))
+            log_file.readline()
+            position = log_file.tell()
+            if position >= end:
+                break
+            if position > bounds[-1]:
+                bounds.append(position)
+
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def aggregate_file_range(
+    file_range,
+    log_path,
+    parse_log_record,
+    aggregate_factory,
+    errors_limit=None,
+    errors_warmup=ERRORS_WARMUP_LINES,
+    timings=None,
+):
+    start, end = file_range
+    with open_log_buffer(log_path) as buf:
+        return aggregate_buffer(
+            buf,
+            parse_log_record,
+            aggregate_factory,
+            start,
+            end,
+            errors_limit=errors_limit,
+            errors_warmup=errors_warmup,
+            log_size=len(buf),
+            timings=timings,
+        )
+
+
+def aggregate_chunk(
+    chunk,
+    parse_log_record,
+    aggregate_factory,
+    errors_limit=None,
+    errors_warmup=ERRORS_WARMUP_LINES,
+):
+    return aggregate_buffer(
+        chunk,
+        parse_log_record,
+        aggregate_factory,
+        errors_limit=errors_limit,
+        errors_warmup=errors_warmup,
+    )
+
+
+def get_log_aggregate_parallel(
+    log_path,
+    parse_log_record,
+    errors_limit,
+    workers,
+    aggregate_factory=LogAggregate,
+    start=0,
+    end=None,
+    decompressor="inline",
+    timings=None,
+    errors_warmup=ERRORS_WARMUP_LINES,
+):
+    """Aggregates the log in a pool of `workers` processes.
+
+    Plain text files are split into byte ranges which workers read themselves
+    (only [start, end) part of the file is read), gzip files are decompressed
+    here and fanned out to workers by chunks. Partial aggregates are merged
+    in the file order. Workers check the errors limit of their part on the go.
+    """
+    aggregate = aggregate_factory()
+    # parsing happens in workers, only decompression time is reported
+    gzip_timings = defaultdict(float)
+
+    with Pool(workers) as pool:
+        if is_gzip_file(log_path):
+            worker = partial(
+                aggregate_chunk,
+                parse_log_record=parse_log_record,
+                aggregate_factory=aggregate_factory,
+                errors_limit=errors_limit,
+                errors_warmup=errors_warmup,
+            )
+            tasks = read_gzip_chunks(log_path, decompressor, gzip_timings)
+        else:
+            worker = partial(
+                aggregate_file_range,
+                log_path=log_path,
+                parse_log_record=parse_log_record,
+                aggregate_factory=aggregate_factory,
+                errors_limit=errors_limit,
+                errors_warmup=errors_warmup,
+            )
+            tasks = split_file_ranges(log_path, workers, start, end)
+
+        for partial_aggregate in pool.imap(worker, tasks):
+            aggregate.merge(partial_aggregate)
+
+    if timings is not None and "decompress" in gzip_timings:
+        timings["decompress"] += gzip_timings["decompress"]
+
+    check_errors_limit(aggregate.errors, aggregate.total_records, errors_limit)
+
+    return aggregate
+
+
+####################################
+# Incremental analyzing
+####################################
+
+
+def get_checkpoint_path(checkpoint_dir, log_path):
+    return os.path.join(checkpoint_dir, os.path.basename(log_path) + ".json")
+
+
+def load_checkpoint(checkpoint_path):
+    if not os.path.isfile(checkpoint_path):
+        return None
+
+    with open(checkpoint_path, "rb") as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+    if checkpoint_dir and not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def get_log_fingerprint(log_path, offset):
+    """Hash of CHECKPOINT_FINGERPRINT_SIZE bytes before `offset`"""
+    start = max(0, offset - CHECKPOINT_FINGERPRINT_SIZE)
+    with open(log_path, "rb") as log_file:
+        log_file.seek(start)
+        return hashlib.sha1(log_file.read(offset - start)).hexdigest()
+
+
+def is_checkpoint_valid(checkpoint, log_path, log_stat, aggregate_settings):
+    """Checkpoint is valid while the log is the same file and it only grew.
+    A log truncated in place (copytruncate) keeps its inode and may grow
+    back past the offset, so the bytes before the offset are compared too"""
+    return (
+        checkpoint is not None
+        and checkpoint["inode"] == log_stat.st_ino
+        and checkpoint["offset"] <= log_stat.st_size
+        and checkpoint["settings"] == aggregate_settings
+        and checkpoint.get("fingerprint")
+        == get_log_fingerprint(log_path, checkpoint["offset"])
+    )
+
+
+def is_log_changed(checkpoint, log_path):
+    log_stat = os.stat(log_path)
+    return (
+        checkpoint["inode"] != log_stat.st_ino or checkpoint["size"] != log_stat.st_size
+    )
+
+
+def get_complete_lines_end(log_path, start, size):
+    """Returns position after the last newline in [start, size) range,
+    so a line that is still being written is left for the next run"""
+    block_size = 64 * 1024
+    end = size
+
+    with open(log_path, "rb") as log_file:
+        while end > start:
+            block_start = max(start, end - block_size)
+            log_file.seek(block_start)
+            newline = log_file.read(end - block_start).rfind(b"\n")
+            if newline != -1:
+                return block_start + newline + 1
+            end = block_start
+
+    return start
+
+
+def get_log_aggregate_incremental(
+    log_path,
+    parse_log_record,
+    errors_limit,
+    workers,
+    aggregate_factory,
+    aggregate_settings,
+    checkpoint,
+    decompressor="inline",
+    timings=None,
+    counters=None,
+):
+    """Aggregates only data appended to the log since the checkpoint.
+
+    Plain text logs are parsed from the checkpoint offset up to the last
+    complete line. Gzip logs can't be read from an offset, so they are
+    parsed again when their size changes. Returns aggregate and new checkpoint,
+    numbers of records and errors parsed and of bytes read in this run are
+    put to `counters` if it's given.
+    """
+    if counters is None:
+        counters = {}
+    counters.update(records=0, errors=0, bytes=0)
+    log_stat = os.stat(log_path)
+    aggregate = aggregate_factory()
+
+    if is_checkpoint_valid(checkpoint, log_path, log_stat, aggregate_settings):
+        start = checkpoint["offset"]
+        aggregate.load(checkpoint["aggregate"])
+    else:
+        start = 0
+
+    if is_gzip_file(log_path):
+        if start != log_stat.st_size:
+            aggregate = aggregate_factory()
+            if workers > 1:
+                aggregate = get_log_aggregate_parallel(
+                    log_path,
+                    parse_log_record,
+                    None,
+                    workers,
+                    aggregate_factory,
+                    decompressor=decompressor,
+                    timings=timings,
+                )
+            else:
+                for chunk in read_gzip_chunks(log_path, decompressor, timings):
+                    aggregate_buffer(
+                        chunk, parse_log_record, aggregate=aggregate, timings=timings
+                    )
+            counters.update(
+                records=aggregate.total_records,
+                errors=aggregate.errors,
+                bytes=log_stat.st_size,
+            )
+        end = log_stat.st_size
+    else:
+        end = get_complete_lines_end(log_path, start, log_stat.st_size)
+        if workers > 1:
+            delta = get_log_aggregate_parallel(
+                log_path,
+                parse_log_record,
+                None,
+                workers,
+                aggregate_factory,
+                start,
+                end,
+            )
+        else:
+            delta = aggregate_file_range(
+                (start, end),
+                log_path,
+                parse_log_record,
+                aggregate_factory,
+                timings=timings,
+            )
+        counters.update(
+            records=delta.total_records, errors=delta.errors, bytes=end - start
+        )
+        aggregate.merge(delta)
+
+    check_errors_limit(aggregate.errors, aggregate.total_records, errors_limit)
+
+    new_checkpoint = {
+        "inode": log_stat.st_ino,
+        "size": log_stat.st_size,
+        "offset": end,
+        "fingerprint": get_log_fingerprint(log_path, end),
+        "settings": aggregate_settings,
+        "aggregate": aggregate.to_dict(),
+    }
+    return aggregate, new_checkpoint
+
+
+####################################
+# Parsed logs cache
+####################################
+
+# Parsed log is stored as a header, uint32 href codes, float32 response
+# times (both in native byte order) and newline separated table of hrefs.
+# Header: magic, records, errors, hrefs table size and size, mtime and inode
+# of the source log.
+PARSED_CACHE_HEADER = struct.Struct("<8sQQQQqQ")
+PARSED_CACHE_MAGIC = b"NGXLOG01"
+# nginx logs request time in milliseconds, float32 values are rounded back
+TIME_PRECISION = 3
+
+
+def get_parsed_cache_path(cache_dir, log_path):
+    return os.path.join(cache_dir, os.path.basename(log_path) + ".parsed")
+
+
+def read_parsed_cache_header(cache_path):
+    with open(cache_path, "rb") as cache_file:
+        header = cache_file.read(PARSED_CACHE_HEADER.size)
+
+    if len(header) < PARSED_CACHE_HEADER.size:
+        return None
+
+    fields = PARSED_CACHE_HEADER.unpack(header)
+    if fields[0] != PARSED_CACHE_MAGIC:
+        return None
+
+    return dict(
+        zip(
+            ("records", "errors", "hrefs_size", "size", "mtime_ns", "inode"),
+            fields[1:],
+        )
+    )
+
+
+def is_parsed_cache_valid(cache_path, log_path):
+    """Cache is valid while the source log is not changed"""
+    if not os.path.isfile(cache_path):
+        return False
+
+    header = read_parsed_cache_header(cache_path)
+    log_stat = os.stat(log_path)
+    return (
+        header is not None
+        and header["size"] == log_stat.st_size
+        and header["mtime_ns"] == log_stat.st_mtime_ns
+        and header["inode"] == log_stat.st_ino
+    )
+
+
+def write_parsed_cache(cache_path, records, log_stat, counters):
+    """Passes records through and writes them to the cache when they are over.
+    `counters` must be filled by get_log_records by that moment"""
+    codes = {}
+    hrefs = []
+    href_codes = array("I")
+    times = array("f")
+
+    for href, response_time in records:
+        code = codes.get(href)
+        if code is None:
+            code = codes[href] = len(hrefs)
+            hrefs.append(href)
+        href_codes.append(code)
+        times.append(response_time)
+
+        yield href, response_time
+
+    hrefs_table = "\n".join(hrefs).encode("utf-8")
+    header = PARSED_CACHE_HEADER.pack(
+        PARSED_CACHE_MAGIC,
+        len(times),
+        counters.get("errors", 0),
+        len(hrefs_table),
+        log_stat.st_size,
+        log_stat.st_mtime_ns,
+        log_stat.st_ino,
+    )
+
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as cache_file:
+        cache_file.write(header)
+        href_codes.tofile(cache_file)
+        times.tofile(cache_file)
+        cache_file.write(hrefs_table)
+    os.replace(tmp_path, cache_path)
+
+
+def aggregate_parsed_cache(
+    cache_path, aggregate_factory=LogAggregate, errors_limit=None
+):
+    """Aggregates records of the memory-mapped cache, no log parsing is done"""
+    header = read_parsed_cache_header(cache_path)
+    records = header["records"]
+    codes_start = PARSED_CACHE_HEADER.size
+    times_start = codes_start + 4 * records
+    hrefs_start = times_start + 4 * records
+
+    aggregate = aggregate_factory()
+
+    with open_log_buffer(cache_path) as buf:
+        view = memoryview(buf)
+        hrefs_end = hrefs_start + header["hrefs_size"]
+        hrefs_table = bytes(view[hrefs_start:hrefs_end])
+        hrefs = [sys.intern(href) for href in hrefs_table.decode("utf-8").split("\n")]
+        href_codes = view[codes_start:times_start].cast("I")
+        times = view[times_start:hrefs_start].cast("f")
+
+        if isinstance(aggregate, ColumnarAggregate):
+            aggregate.total_records += records
+            aggregate.errors += header["errors"]
+            times = np.round(np.asarray(times, dtype=np.float64), TIME_PRECISION)
+            aggregate.total_time += float(times.sum())
+            aggregate.extend(hrefs, href_codes, times)
+        else:
+            aggregate.errors += header["errors"]
+            for code, response_time in zip(href_codes, times):
+                aggregate.add(hrefs[code], round(response_time, TIME_PRECISION))
+
+        del href_codes, times, view
+
+    check_errors_limit(aggregate.errors, aggregate.total_records, errors_limit)
+
+    return aggregate
+
+
+####################################
+# Live tail
+####################################
+
+
+class RollingWindows:
+    """Per-URL stats over the last minutes of a live log.
+
+    Records go to a ring of fixed time buckets, one aggregate per bucket,
+    so memory is bounded by the number of buckets and aggregates' max_urls.
+    Windows are merged from their buckets when a snapshot is taken.
+    """
+
+    def __init__(self, aggregate_factory, windows=FOLLOW_WINDOWS, bucket_seconds=10):
+        self.aggregate_factory = aggregate_factory
+        self.windows = windows
+        self.bucket_seconds = bucket_seconds
+
+        size = math.ceil(max(span for _, span in windows) / bucket_seconds)
+        self.bucket_ids = [None] * size
+        self.buckets = [None] * size
+
+    def get_bucket(self, now):
+        bucket_id = int(now // self.bucket_seconds)
+        slot = bucket_id % len(self.buckets)
+        if self.bucket_ids[slot] != bucket_id:
+            # the slot holds a bucket which has left every window
+            self.bucket_ids[slot] = bucket_id
+            self.buckets[slot] = self.aggregate_factory()
+
+        return self.buckets[slot]
+
+    def add(self, href, response_time, now):
+        self.get_bucket(now).add(href, response_time)
+
+    def add_error(self, now):
+        self.get_bucket(now).errors += 1
+
+    def get_window(self, span, now):
+        last_id = int(now // self.bucket_seconds)
+        first_id = last_id - math.ceil(span / self.bucket_seconds) + 1
+
+        window = self.aggregate_factory()
+        for bucket_id, bucket in zip(self.bucket_ids, self.buckets):
+            if bucket_id is not None and first_id <= bucket_id <= last_id:
+                window.merge(bucket)
+
+        return window
+
+    def snapshot(self, now, max_urls=None):
+        snapshot = {}
+        for name, span in self.windows:
+            window = self.get_window(span, now)
+            snapshot[name] = {
+                "total_records": window.total_records,
+                "errors": window.errors,
+                "urls": build_report(window, max_urls),
+            }
+
+        return snapshot
+
+
+def is_log_rotated(log_path, log_file):
+    """Log is rotated when its path leads to another file, or truncated"""
+    try:
+        path_stat = os.stat(log_path)
+    except FileNotFoundError:
+        # moved away, but nginx may still write to it until the new one appears
+        return False
+
+    file_stat = os.fstat(log_file.fileno())
+    return (path_stat.st_dev, path_stat.st_ino) != (
+        file_stat.st_dev,
+        file_stat.st_ino,
+    ) or path_stat.st_size < log_file.tell()
+
+
+def follow_log_lines(log_path, poll_interval=1.0, from_start=False, sleep=time.sleep):
+    """Yields complete lines appended to the log, follows it across rotation.
+    None is yielded when there is nothing new, so callers can do periodic work
+    while the log is quiet"""
+    log_file = None
+    tail = b""
+    rotated = False
+
+    try:
+        while True:
+            if log_file is None:
+                try:
+                    log_file = open(log_path, "rb")
+                except FileNotFoundError:
+                    yield None
+                    sleep(poll_interval)
+                    continue
+
+                if not from_start:
+                    log_file.seek(0, os.SEEK_END)
+                # logs which appear after rotation are read from their start
+                from_start = True
+                tail = b""
+                rotated = False
+
+            data = log_file.read(FOLLOW_READ_SIZE)
+            if data:
+                lines = (tail + data).split(b"\n")
+                tail = lines.pop()
+                yield from lines
+                continue
+
+            if rotated:
+                # the old log is drained, the rest of it goes to the new one
+                log_file.close()
+                log_file = None
+                continue
+
+            rotated = is_log_rotated(log_path, log_file)
+            if not rotated:
+                yield None
+                sleep(poll_interval)
+    finally:
+        if log_file is not None:
+            log_file.close()
+
+
+def save_live_snapshot(snapshot_path, log_path, windows, now, max_urls=None):
+    snapshot = {
+        "log": log_path,
+        "generated": datetime.fromtimestamp(now).isoformat(timespec="seconds"),
+        "windows": windows.snapshot(now, max_urls),
+    }
+
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(tmp_path, snapshot_path)
+
+
+def follow(config, lines=None, clock=time.time):
+    """Tails the active log and dumps rolling window stats to
+    REPORT_DIR/live.json every FOLLOW_SNAPSHOT_INTERVAL seconds"""
+    log_path = config.get("FOLLOW_LOG") or os.path.join(
+        config["LOG_DIR"], FOLLOW_LOG_NAME
+    )
+    if lines is None:
+        lines = follow_log_lines(log_path, config.get("FOLLOW_POLL_INTERVAL", 1.0))
+
+    parse_fn = get_parser(config.get("PARSER", "regex"))
+
+    # bounded memory needs mergeable sketches instead of exact histograms
+    follow_config = dict(
+        config,
+        AGGREGATION_BACKEND="python",
+        QUANTILE_ENGINE="histogram",
+        MAX_URLS=config.get("MAX_URLS") or FOLLOW_MAX_URLS,
+        GROUP_BY=None,
+    )
+    aggregate_factory = get_aggregate_factory(get_aggregate_settings(follow_config))
+    windows = RollingWindows(
+        aggregate_factory, bucket_seconds=config.get("FOLLOW_BUCKET_SECONDS", 10)
+    )
+
+    snapshot_path = os.path.join(config["REPORT_DIR"], FOLLOW_SNAPSHOT_NAME)
+    snapshot_interval = config.get("FOLLOW_SNAPSHOT_INTERVAL", 60)
+    max_urls = config.get("MAX_REPORT_SIZE")
+
+    logging.info("Following {}".format(os.path.normpath(log_path)))
+
+    now = clock()
+    next_snapshot = now + snapshot_interval
+    try:
+        for line in lines:
+            now = clock()
+            if line is not None:
+                parsed_line = parse_fn(line)
+                if parsed_line is None:
+                    windows.add_error(now)
+                else:
+                    windows.add(*parsed_line, now)
+
+            if now >= next_snapshot:
+                save_live_snapshot(snapshot_path, log_path, windows, now, max_urls)
+                next_snapshot = now + snapshot_interval
+    except KeyboardInterrupt:
+        logging.info("Stopped following {}".format(os.path.normpath(log_path)))
+
+    save_live_snapshot(snapshot_path, log_path, windows, now, max_urls)
+    return snapshot_path
+
+
 ####################################
 # Utils
 ####################################
@@ -144,24 +2088,76 @@ def setup_logger(log_path):
     )
 
 
-def get_latest_log_info(files_dir):
-    if not os.path.isdir(files_dir):
+def scan_log_files(files_dir):
+    """Returns info of all log files in the dir sorted by date. When there
+    are plain and gzip logs of one date, the plain one is taken"""
+    files_info = {}
+
+    with os.scandir(files_dir) as entries:
+        for entry in entries:
+            match = LOG_NAME_RE.fullmatch(entry.name)
+            if not match or not entry.is_file():
+                continue
+
+            file_date = match.group("date")
+            if file_date not in files_info or entry.name < files_info[file_date]:
+                files_info[file_date] = entry.name
+
+    return [
+        {"file_date": file_date, "name": files_info[file_date]}
+        for file_date in sorted(files_info)
+    ]
+
+
+def load_log_index(index_path, files_dir, dir_mtime):
+    """Returns files info saved for the dir, None when the dir was changed"""
+    try:
+        with open(index_path, "rb") as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
         return None
 
-    latest_file_info = {"file_date": 0, "name": None}
+    if index.get("dir") != files_dir or index.get("mtime_ns") != dir_mtime:
+        return None
 
-    for filename in os.listdir(files_dir):
-        match = re.match(r"^nginx-access-ui\.log-(?P<date>\d{8})(\.gz)?$", filename)
-        if not match:
-            continue
+    return index["files"]
+
+
+def save_log_index(index_path, files_dir, dir_mtime, files_info):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as index_file:
+        json.dump(
+            {"dir": files_dir, "mtime_ns": dir_mtime, "files": files_info}, index_file
+        )
+    os.replace(tmp_path, index_path)
 
-        file_date = re.search(r"(?P<date>\d{8})", filename).group(0)
-        if int(file_date) > int(latest_file_info["file_date"]):
-            latest_file_info["file_date"] = file_date
-            latest_file_info["name"] = filename
 
-    if latest_file_info["name"]:
-        return latest_file_info
+def get_log_files_info(files_dir, index_path=None):
+    """Returns info of all log files in the dir sorted by date.
+
+    With `index_path` the list is cached there and the dir is scanned again
+    only when its mtime changes, i.e. when files are added, removed or renamed.
+    """
+    if not os.path.isdir(files_dir):
+        return []
+
+    if index_path is None:
+        return scan_log_files(files_dir)
+
+    files_dir = os.path.abspath(files_dir)
+    dir_mtime = os.stat(files_dir).st_mtime_ns
+    files_info = load_log_index(index_path, files_dir, dir_mtime)
+    if files_info is None:
+        files_info = scan_log_files(files_dir)
+        save_log_index(index_path, files_dir, dir_mtime, files_info)
+
+    return files_info
+
+
+def get_latest_log_info(files_dir, index_path=None):
+    files_info = get_log_files_info(files_dir, index_path)
+    if files_info:
+        return files_info[-1]
 
     return None
 
@@ -170,6 +2166,19 @@ def is_gzip_file(file_path):
     return file_path.split(".")[-1] == "gz"
 
 
+REPORT_TABLE_PLACEHOLDER = "\0table_json\0"
+
+
+def write_json_rows(report_file, rows):
+    """Writes rows as json list, encoding one row at a time"""
+    report_file.write("[")
+    for i, row in enumerate(rows):
+        if i:
+            report_file.write(", ")
+        report_file.write(json.dumps(row))
+    report_file.write("]")
+
+
 def render_template(template_path, to, data):
     if data is None:
         data = []
@@ -178,42 +2187,515 @@ def render_template(template_path, to, data):
     with open(template_file_path) as template_file:
         template = Template(template_file.read())
 
-    report = template.safe_substitute(table_json=json.dumps(data))
-    with open(to, "w") as report_file:
+    # the table is streamed between template parts instead of substituted
+    prefix, placeholder, suffix = template.safe_substitute(
+        table_json=REPORT_TABLE_PLACEHOLDER
+    ).partition(REPORT_TABLE_PLACEHOLDER)
+
+    # readers never see a half-written report
+    tmp_path = to + ".tmp"
+    with open(tmp_path, "w") as report_file:
+        report_file.write(prefix)
+        if placeholder:
+            write_json_rows(report_file, data)
+            report_file.write(suffix)
+    os.replace(tmp_path, to)
+
+
+REPORT_FORMATS = ("inline", "paged")
+REPORT_PAGE_NAME = "page-{:05d}.js"
+# pages are scripts which pass their rows to this function of the report,
+# browsers run scripts from file:// unlike fetch of json
+REPORT_PAGE_CALLBACK = "reportPage"
+REPORT_INDEX_NAME = "index.json"
+
+
+def write_report_pages(data_dir, rows, page_size):
+    """Writes rows to data_dir as script pages of `page_size` rows, only one
+    page is kept in memory. Returns the index of pages"""
+    tmp_dir = data_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    rows = iter(rows)
+    index = {"rows": 0, "page_size": page_size, "pages": 0, "columns": []}
+    while True:
+        page = list(itertools.islice(rows, page_size))
+        if not page:
+            break
+
+        if not index["columns"]:
+            index["columns"] = list(page[0])
+        page_path = os.path.join(tmp_dir, REPORT_PAGE_NAME.format(index["pages"]))
+        with open(page_path, "w") as page_file:
+            page_file.write("{}({}, ".format(REPORT_PAGE_CALLBACK, index["pages"]))
+            write_json_rows(page_file, page)
+            page_file.write(");\n")
+
+        index["rows"] += len(page)
+        index["pages"] += 1
+
+    with open(os.path.join(tmp_dir, REPORT_INDEX_NAME), "w") as index_file:
+        json.dump(index, index_file)
+
+    # pages of the previous report are replaced at once
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.replace(tmp_dir, data_dir)
+
+    return index
+
+
+def render_report_shell(template_path, to, index, data_url):
+    template_file_path = os.path.join(template_path, "report_paged.html")
+    with open(template_file_path) as template_file:
+        template = Template(template_file.read())
+
+    report = template.safe_substitute(
+        report_index=json.dumps(dict(index, data_url=data_url)),
+        report_page_callback=REPORT_PAGE_CALLBACK,
+    )
+
+    tmp_path = to + ".tmp"
+    with open(tmp_path, "w") as report_file:
         report_file.write(report)
+    os.replace(tmp_path, to)
 
 
-def main(config):
-    latest_log_info = get_latest_log_info(config.get("LOG_DIR"))
+def get_report_data_dir(report_file_path):
+    return os.path.splitext(report_file_path)[0] + ".data"
 
-    if not latest_log_info:
-        logging.info("Ooops. No log files yet")
+
+def save_report(config, report_file_path, report_data):
+    """Renders the report with its table inlined or split to pages"""
+    report_format = config.get("REPORT_FORMAT", "inline")
+    if report_format not in REPORT_FORMATS:
+        raise ValueError("Unknown report format {}".format(report_format))
+
+    template_path = config.get("REPORT_TEMPLATE_PATH")
+    if report_format == "inline":
+        render_template(template_path, report_file_path, report_data)
         return
 
-    report_date_string = datetime.strptime(
-        latest_log_info["file_date"], "%Y%m%d"
-    ).strftime("%Y.%m.%d")
+    # pages go first, so the report never points to missing pages
+    data_dir = get_report_data_dir(report_file_path)
+    index = write_report_pages(
+        data_dir, report_data, config.get("REPORT_PAGE_SIZE") or 1000
+    )
+    render_report_shell(
+        template_path, report_file_path, index, os.path.basename(data_dir)
+    )
+
+
+@contextmanager
+def measure_stage(stages, name):
+    """Adds wall and CPU time of the block to stages[name]"""
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    try:
+        yield
+    finally:
+        stage = stages.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+        stage["wall"] += time.perf_counter() - started
+        stage["cpu"] += time.process_time() - cpu_started
+
+
+def get_peak_rss():
+    """Peak resident set size in bytes of this process and of its finished
+    children (parallel workers), None when it can't be measured"""
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def log_run_stats(stats):
+    for name, stage in stats["stages"].items():
+        logging.info(
+            "Stage {}: {:.2f}s wall, {:.2f}s CPU".format(
+                name, stage["wall"], stage["cpu"]
+            )
+        )
+    if stats["workers"] > 1:
+        logging.info(
+            "CPU time is of the main process only, "
+            "{} worker processes aren't counted".format(stats["workers"])
+        )
+
+    if stats["parsed_cache"]:
+        logging.info("The log isn't read, lines are taken from parsed cache")
+    logging.info(
+        "{} lines ({:.0f} lines/sec, {:.2f} MB/sec), {:.2%} errors, "
+        "{} distinct URLs".format(
+            stats["lines"],
+            stats["lines_per_sec"],
+            stats["bytes_per_sec"] / 1024.0 / 1024.0,
+            stats["error_rate"],
+            stats["distinct_urls"],
+        )
+    )
+    if stats["peak_rss"] is not None:
+        logging.info("Peak RSS {:.1f} MB".format(stats["peak_rss"] / 1024.0 / 1024.0))
+
+
+def get_stats_path(report_file_path):
+    return os.path.splitext(report_file_path)[0] + ".stats.json"
+
+
+def save_stats(stats_path, stats):
+    tmp_path = stats_path + ".tmp"
+    with open(tmp_path, "w") as stats_file:
+        json.dump(stats, stats_file, indent=2)
+    os.replace(tmp_path, stats_path)
+
+
+def get_group_reports_path(report_file_path):
+    return os.path.splitext(report_file_path)[0] + ".groups.json"
+
+
+def save_group_reports(reports_path, reports):
+    tmp_path = reports_path + ".tmp"
+    with open(tmp_path, "w") as reports_file:
+        json.dump(reports, reports_file)
+    os.replace(tmp_path, reports_path)
+
+
+def get_report_date(log_info):
+    return datetime.strptime(log_info["file_date"], "%Y%m%d").strftime("%Y.%m.%d")
+
+
+def get_report_path(report_dir, log_info):
+    return os.path.join(report_dir, "report-{}.html".format(get_report_date(log_info)))
+
+
+def get_aggregate_path(report_dir, report_date):
+    return os.path.join(report_dir, "aggregate-{}.json".format(report_date))
+
+
+def save_aggregate(aggregate_path, aggregate_settings, aggregate):
+    """Saves daily aggregate next to the report, so rollups don't need the log"""
+    tmp_path = aggregate_path + ".tmp"
+    with open(tmp_path, "w") as aggregate_file:
+        json.dump(
+            {"settings": aggregate_settings, "aggregate": aggregate.to_dict()},
+            aggregate_file,
+        )
+    os.replace(tmp_path, aggregate_path)
+
+
+def build_log_report(log_info, config):
+    """Builds the report of a single log file.
+
+    Returns processing stats or None when the report is up-to-date.
+    """
+    report_file_path = get_report_path(config["REPORT_DIR"], log_info)
+    log_path = os.path.join(config["LOG_DIR"], log_info["name"])
+
+    checkpoint_dir = config.get("CHECKPOINT_DIR")
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint_path = get_checkpoint_path(checkpoint_dir, log_path)
+        checkpoint = load_checkpoint(checkpoint_path)
+
+    if os.path.isfile(report_file_path) and (
+        checkpoint is None or not is_log_changed(checkpoint, log_path)
+    ):
+        logging.info("Looks like everything is up-to-date")
+        return None
+
+    started = time.perf_counter()
+    stages = {}
+
+    logging.info('Collecting data from "{}"'.format(os.path.normpath(log_path)))
+
+    workers = config.get("WORKERS") or 1
+    decompressor = config.get("GZIP_DECOMPRESSOR", "inline")
+    timings = defaultdict(float)
+    aggregate_settings = get_aggregate_settings(config)
+    aggregate_factory = get_aggregate_factory(aggregate_settings)
+    group_by = aggregate_settings["group_by"]
+    parse_fn = get_parser(config.get("PARSER", "regex"), group_by)
+
+    # incremental runs parse only the tail of the log, so the whole log
+    # can't be cached there, group-by fields aren't cached at all
+    parsed_cache_dir = None
+    if not checkpoint_dir and not group_by:
+        parsed_cache_dir = config.get("PARSED_CACHE_DIR")
+    if parsed_cache_dir:
+        parsed_cache_path = get_parsed_cache_path(parsed_cache_dir, log_path)
+
+    errors_limit = config.get("ERRORS_LIMIT")
+    errors_warmup = config.get("ERRORS_WARMUP", ERRORS_WARMUP_LINES)
+    use_parsed_cache = parsed_cache_dir and is_parsed_cache_valid(
+        parsed_cache_path, log_path
+    )
+
+    # records and errors parsed and bytes of the log read in this run
+    counters = {}
+    with measure_stage(stages, "collect"):
+        if not use_parsed_cache:
+            probe_log_format(
+                log_path,
+                parse_fn,
+                errors_limit,
+                config.get("FORMAT_PROBE_LINES", FORMAT_PROBE_LINES),
+            )
+
+        if checkpoint_dir:
+            aggregate, checkpoint = get_log_aggregate_incremental(
+                log_path,
+                parse_fn,
+                errors_limit,
+                workers,
+                aggregate_factory,
+                aggregate_settings,
+                checkpoint,
+                decompressor,
+                timings,
+                counters,
+            )
+        elif use_parsed_cache:
+            logging.info("Using parsed log {}".format(parsed_cache_path))
+            aggregate = aggregate_parsed_cache(
+                parsed_cache_path, aggregate_factory, errors_limit
+            )
+            counters.update(
+                records=aggregate.total_records, errors=aggregate.errors, bytes=0
+            )
+        elif workers > 1:
+            aggregate = get_log_aggregate_parallel(
+                log_path,
+                parse_fn,
+                errors_limit,
+                workers,
+                aggregate_factory,
+                decompressor=decompressor,
+                timings=timings,
+                errors_warmup=errors_warmup,
+            )
+            counters.update(
+                records=aggregate.total_records,
+                errors=aggregate.errors,
+                bytes=os.path.getsize(log_path),
+            )
+        else:
+            log_records = get_log_records(
+                log_path,
+                parse_fn,
+                errors_limit,
+                decompressor,
+                timings,
+                counters,
+                errors_warmup,
+            )
+            if parsed_cache_dir:
+                log_records = write_parsed_cache(
+                    parsed_cache_path, log_records, os.stat(log_path), counters
+                )
+            aggregate = aggregate_records(log_records, aggregate_factory)
+            aggregate.errors = counters["errors"]
+            counters["bytes"] = os.path.getsize(log_path)
+
+    if "decompress" in timings:
+        logging.info("Decompression took {:.2f}s".format(timings["decompress"]))
+    if "parse" in timings:
+        logging.info("Parsing took {:.2f}s".format(timings["parse"]))
+    if "aggregate" in timings:
+        logging.info("Aggregation took {:.2f}s".format(timings["aggregate"]))
+
+    with measure_stage(stages, "build_report"):
+        report_data = build_report(aggregate, config.get("MAX_REPORT_SIZE"))
+
+    with measure_stage(stages, "render"):
+        save_report(config, report_file_path, report_data)
+        if group_by:
+            save_group_reports(
+                get_group_reports_path(report_file_path),
+                build_group_reports(aggregate),
+            )
+
+    with measure_stage(stages, "save"):
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_path, checkpoint)
+
+        if config.get("SAVE_AGGREGATES"):
+            aggregate_path = get_aggregate_path(
+                config["REPORT_DIR"], get_report_date(log_info)
+            )
+            save_aggregate(aggregate_path, aggregate_settings, aggregate)
+
+    elapsed = time.perf_counter() - started
+    # only what this run parsed, not records of the checkpoint
+    lines = counters["records"] + counters["errors"]
+    stats = {
+        "log": log_path,
+        "report": report_file_path,
+        "elapsed": elapsed,
+        "bytes": counters["bytes"],
+        "parsed_cache": bool(use_parsed_cache),
+        "stages": stages,
+        # parts of "collect", measured where the work is done, parsing and
+        # aggregation in worker processes aren't timed
+        "timings": dict(timings),
+        "workers": workers,
+        "lines": lines,
+        "errors": counters["errors"],
+        "error_rate": counters["errors"] / lines if lines else 0.0,
+        "lines_per_sec": lines / elapsed if elapsed else 0.0,
+        "bytes_per_sec": counters["bytes"] / elapsed if elapsed else 0.0,
+        "distinct_urls": len(aggregate.urls),
+        "peak_rss": get_peak_rss(),
+    }
+    log_run_stats(stats)
+
+    if config.get("SAVE_STATS"):
+        save_stats(get_stats_path(report_file_path), stats)
+
+    logging.info(
+        "Report saved to {} in {:.2f}s ({:.2f} MB/sec)".format(
+            os.path.normpath(report_file_path),
+            elapsed,
+            stats["bytes_per_sec"] / 1024.0 / 1024.0,
+        )
+    )
+
+    return stats
+
+
+def backfill_log_report(log_info, config):
+    try:
+        return build_log_report(log_info, config)
+    except Exception as e:
+        logging.exception(msg=e)
+        return None
+
 
-    report_filename = "report-{}.html".format(report_date_string)
-    report_file_path = os.path.join(config["REPORT_DIR"], report_filename)
+def backfill(config):
+    """Builds reports for every log without a report in a pool of processes"""
+    pending = [
+        log_info
+        for log_info in get_log_files_info(
+            config.get("LOG_DIR"), config.get("LOG_INDEX_PATH")
+        )
+        if not os.path.isfile(get_report_path(config["REPORT_DIR"], log_info))
+    ]
 
-    if os.path.isfile(report_file_path):
+    if not pending:
         logging.info("Looks like everything is up-to-date")
         return
 
-    latest_log_path = os.path.join(config["LOG_DIR"], latest_log_info["name"])
+    logging.info("Backfilling {} reports".format(len(pending)))
 
-    logging.info('Collecting data from "{}"'.format(os.path.normpath(latest_log_path)))
+    # files are processed concurrently, so each of them is parsed by one process
+    file_config = dict(config, WORKERS=1)
+    started = time.perf_counter()
 
-    log_records = get_log_records(
-        latest_log_path, parse_log_record, config.get("ERRORS_LIMIT")
+    with Pool(config.get("BACKFILL_WORKERS") or os.cpu_count()) as pool:
+        worker = partial(backfill_log_report, config=file_config)
+        results = pool.map(worker, pending)
+
+    done = [stats for stats in results if stats is not None]
+    logging.info(
+        "Backfilled {} of {} reports in {:.2f}s".format(
+            len(done), len(pending), time.perf_counter() - started
+        )
     )
 
-    report_data = create_report(log_records, config["MAX_REPORT_SIZE"])
 
-    render_template(config.get("REPORT_TEMPLATE_PATH"), report_file_path, report_data)
+def load_rollup_aggregate(report_dir, from_date, to_date):
+    """Merges saved daily aggregates over [from_date, to_date] days
+    (YYYY.MM.DD). Days which are missing or were aggregated with other
+    settings than the first found day are skipped"""
+    day = datetime.strptime(from_date, "%Y.%m.%d")
+    last_day = datetime.strptime(to_date, "%Y.%m.%d")
+    if day > last_day:
+        raise ValueError(
+            "Rollup start {} is after its end {}".format(from_date, to_date)
+        )
+
+    aggregate = None
+    settings = None
+
+    while day <= last_day:
+        report_date = day.strftime("%Y.%m.%d")
+        day += timedelta(days=1)
+
+        aggregate_path = get_aggregate_path(report_dir, report_date)
+        if not os.path.isfile(aggregate_path):
+            logging.warning("No aggregate for {}".format(report_date))
+            continue
+
+        with open(aggregate_path, "rb") as aggregate_file:
+            saved = json.load(aggregate_file)
+
+        if aggregate is None:
+            settings = saved["settings"]
+            aggregate = get_aggregate_factory(settings)()
+        elif saved["settings"] != settings:
+            logging.warning("Aggregate for {} has other settings".format(report_date))
+            continue
+
+        aggregate.load(saved["aggregate"])
 
-    logging.info("Report saved to {}".format(os.path.normpath(report_file_path)))
+    return aggregate
+
+
+def rollup(config, from_date, to_date):
+    aggregate = load_rollup_aggregate(config["REPORT_DIR"], from_date, to_date)
+    if aggregate is None:
+        logging.info("Ooops. No aggregates for {} - {}".format(from_date, to_date))
+        return None
+
+    report_file_path = os.path.join(
+        config["REPORT_DIR"], "report-{}-{}.html".format(from_date, to_date)
+    )
+    report_data = build_report(aggregate, config.get("MAX_REPORT_SIZE"))
+    save_report(config, report_file_path, report_data)
+    if isinstance(aggregate, GroupedLogAggregate):
+        save_group_reports(
+            get_group_reports_path(report_file_path), build_group_reports(aggregate)
+        )
+
+    logging.info("Rollup saved to {}".format(os.path.normpath(report_file_path)))
+    return report_file_path
+
+
+def profile_main(config, profile_path):
+    """Runs main under cProfile, stats are saved for pstats or snakeviz"""
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(main, config)
+    finally:
+        profiler.dump_stats(profile_path)
+        logging.info("Profile saved to {}".format(os.path.normpath(profile_path)))
+
+
+def main(config):
+    if config.get("FOLLOW"):
+        follow(config)
+        return
+
+    if config.get("ROLLUP"):
+        rollup(config, *config["ROLLUP"])
+        return
+
+    if config.get("BACKFILL"):
+        backfill(config)
+        return
+
+    latest_log_info = get_latest_log_info(
+        config.get("LOG_DIR"), config.get("LOG_INDEX_PATH")
+    )
+
+    if not latest_log_info:
+        logging.info("Ooops. No log files yet")
+        return
+
+    build_log_report(latest_log_info, config)
 
 
 if __name__ == "__main__":
@@ -221,16 +2703,53 @@ if __name__ == "__main__":
     parser.add_argument(
         "--config", help="Config file path", default=DEFAULT_CONFIG_PATH
     )
+    parser.add_argument(
+        "--workers", type=int, help="Number of processes used to parse the log"
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Build reports for every log file which has no report yet",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Tail the active log and keep rolling 1/5/15-minute stats",
+    )
+    parser.add_argument("--profile", help="Save cProfile stats of the run to file")
+    subparsers = parser.add_subparsers(dest="command")
+    rollup_parser = subparsers.add_parser(
+        "rollup", help="Build report over several days from saved daily aggregates"
+    )
+    rollup_parser.add_argument(
+        "--from", dest="from_date", required=True, help="First day, YYYY.MM.DD"
+    )
+    rollup_parser.add_argument(
+        "--to", dest="to_date", required=True, help="Last day, YYYY.MM.DD"
+    )
     args = parser.parse_args()
 
     args_config = load_conf(args.config)
 
     conf = deepcopy(config)
     conf.update(args_config)
+    if args.workers is not None:
+        conf["WORKERS"] = args.workers
+    if args.backfill:
+        conf["BACKFILL"] = True
+    if args.follow:
+        conf["FOLLOW"] = True
+    if args.profile:
+        conf["PROFILE"] = args.profile
+    if args.command == "rollup":
+        conf["ROLLUP"] = [args.from_date, args.to_date]
 
     setup_logger(config.get("LOG_FILE", None))
 
     try:
-        main(conf)
+        if conf.get("PROFILE"):
+            profile_main(conf, conf["PROFILE"])
+        else:
+            main(conf)
     except Exception as e:
         logging.exception(msg=e)
@@ -27,7 +27,11 @@
 # Можно свободно определять свои функции и т.п.
 # -----------------
 from collections import Counter
+from array import array
 import itertools
+import json
+import os
+import random
 
 RANKS_MAPPING = {
     "2": 2,
@@ -46,6 +50,52 @@ RANKS_MAPPING = {
 }
 
 
+SUITS = "CSHD"
+
+# Карта в виде числа: биты 0-3 - ранг, биты 4-9 - простое число ранга,
+# биты 12-15 - масть (один бит на масть), биты 16-30 - ранг (один бит
+# на ранг, бит 16 + ранг)
+CARD_RANK_MASK = 0xF
+CARD_PRIME_SHIFT = 4
+CARD_PRIME_MASK = 0x3F
+CARD_SUIT_SHIFT = 12
+CARD_SUITS_MASK = 0xF << CARD_SUIT_SHIFT
+CARD_RANK_BIT_SHIFT = 16
+# 13 бит рангов от двойки до туза
+RANK_MASK_SHIFT = CARD_RANK_BIT_SHIFT + 2
+
+# произведение простых чисел рангов одинаково только у рук с одинаковыми рангами
+RANK_PRIMES = {
+    2: 2,
+    3: 3,
+    4: 5,
+    5: 7,
+    6: 11,
+    7: 13,
+    8: 17,
+    9: 19,
+    10: 23,
+    11: 29,
+    12: 31,
+    13: 37,
+    14: 41,
+}
+
+# таблицы hand_rank_table, создаются при первом вызове и сохраняются рядом:
+# массивы флешей и рук из 5ти разных рангов в .flushes и .unique_ranks,
+# произведения простых чисел в .products.json
+RANK_TABLES_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "poker_rank_tables"
+)
+RANK_TABLES_ARRAYS = ("flushes", "unique_ranks")
+RANK_TABLES_VERSION = 1
+HAND_CLASSES = 7462
+
+# hand_rank_bits упаковывает категорию руки в старшие 4 бита, а ранги
+# по 4 бита в порядке сравнения кортежей hand_rank
+HAND_CATEGORY_SHIFT = 28
+
+
 def get_card_rank(str_card):
     """Возвращает ранг переданной карты"""
     return RANKS_MAPPING.get(str_card[0])
@@ -125,6 +175,362 @@ def best_hand(hand):
     return best_hand
 
 
+def encode_card(str_card):
+    """Возвращает карту в виде числа (см. CARD_RANK_MASK)"""
+    rank = get_card_rank(str_card)
+    suit = SUITS.index(get_card_suit(str_card))
+    return (
+        1 << (CARD_RANK_BIT_SHIFT + rank)
+        | 1 << (CARD_SUIT_SHIFT + suit)
+        | RANK_PRIMES[rank] << CARD_PRIME_SHIFT
+        | rank
+    )
+
+
+def encode_hand(hand):
+    """Возвращает кортеж карт руки в виде чисел"""
+    return tuple(encode_card(str_card) for str_card in hand)
+
+
+def hand_rank_bits(cards):
+    """Возвращает ранг 'руки' из 5ти карт в виде числа (см. encode_card).
+    Числа сравниваются так же, как значения hand_rank для тех же карт.
+    Флеш, стрит и одинаковые ранги определяются за один проход по
+    отсортированным рангам, без промежуточных списков и Counter"""
+    c1, c2, c3, c4, c5 = cards
+    is_flush = c1 & c2 & c3 & c4 & c5 & CARD_SUITS_MASK
+    a, b, c, d, e = sorted(
+        (
+            c1 & CARD_RANK_MASK,
+            c2 & CARD_RANK_MASK,
+            c3 & CARD_RANK_MASK,
+            c4 & CARD_RANK_MASK,
+            c5 & CARD_RANK_MASK,
+        )
+    )
+    ranks = a << 16 | b << 12 | c << 8 | d << 4 | e
+
+    if a == d or b == e:
+        # каре, ранг каре всегда b, кикер - e или a
+        return 7 << HAND_CATEGORY_SHIFT | b << 24 | (e if a == d else a) << 20
+    if a == c and d == e or a == b and c == e:
+        # фулл-хаус, тройка всегда c
+        return 6 << HAND_CATEGORY_SHIFT | c << 24 | (e if a == c else a) << 20
+    if a == c or b == d or c == e:
+        return 3 << HAND_CATEGORY_SHIFT | c << 24 | ranks << 4
+
+    pairs = (a == b) + (b == c) + (c == d) + (d == e)
+    if pairs == 2:
+        # две пары, младшая всегда b, старшая всегда d
+        return 2 << HAND_CATEGORY_SHIFT | b << 24 | d << 20 | ranks
+    if pairs == 1:
+        pair = b if a == b or b == c else d
+        return 1 << HAND_CATEGORY_SHIFT | pair << 24 | ranks << 4
+
+    if e - a == 4:
+        return (8 if is_flush else 4) << HAND_CATEGORY_SHIFT | e << 24
+    return (5 if is_flush else 0) << HAND_CATEGORY_SHIFT | ranks << 8
+
+
+# индексы 5ти карт из 7ми в порядке itertools.combinations
+HAND_COMBINATIONS = tuple(itertools.combinations(range(7), 5))
+
+
+def best_hand_bits(hand, evaluate=hand_rank_bits):
+    """То же, что best_hand, но руки сравниваются через evaluate
+    (hand_rank_bits или hand_rank_table)"""
+    cards = encode_hand(hand)
+    best_rank = -1
+    best_indexes = None
+
+    for indexes in HAND_COMBINATIONS:
+        i1, i2, i3, i4, i5 = indexes
+        rank = evaluate((cards[i1], cards[i2], cards[i3], cards[i4], cards[i5]))
+        # при равных рангах остается первая рука, как у max в best_hand
+        if rank > best_rank:
+            best_rank = rank
+            best_indexes = indexes
+
+    return tuple(hand[i] for i in best_indexes)
+
+
+def iter_hand_classes():
+    """Возвращает по одной руке каждого класса эквивалентности: все наборы
+    рангов без флеша и наборы из 5ти разных рангов с флешем"""
+    for ranks in itertools.combinations_with_replacement(sorted(RANK_PRIMES), 5):
+        if max(Counter(ranks).values()) > 4:
+            continue
+        # одинаковые ранги идут подряд, поэтому масти у них разные
+        yield [encode_card_parts(rank, i % 4) for i, rank in enumerate(ranks)]
+        if len(set(ranks)) == 5:
+            yield [encode_card_parts(rank, 0) for rank in ranks]
+
+
+def encode_card_parts(rank, suit):
+    return encode_card(
+        next(key for key, value in RANKS_MAPPING.items() if value == rank) + SUITS[suit]
+    )
+
+
+def get_rank_mask(cards):
+    c1, c2, c3, c4, c5 = cards
+    return (c1 | c2 | c3 | c4 | c5) >> RANK_MASK_SHIFT
+
+
+def get_prime_product(cards):
+    product = 1
+    for card in cards:
+        product *= card >> CARD_PRIME_SHIFT & CARD_PRIME_MASK
+    return product
+
+
+def build_rank_tables():
+    """Нумерует все 7462 класса рук от 1 (худший) в порядке hand_rank_bits.
+    Флеши ищутся по 13ти битной маске рангов, руки из 5ти разных рангов
+    тоже, остальные - по произведению простых чисел рангов"""
+    hands = list(iter_hand_classes())
+    ranks = [hand_rank_bits(cards) for cards in hands]
+    class_ids = {rank: i + 1 for i, rank in enumerate(sorted(set(ranks)))}
+    if len(class_ids) != HAND_CLASSES:
+        raise RuntimeError("Expected {} hand classes".format(HAND_CLASSES))
+
+    flushes = array("H", [0]) * (1 << 13)
+    unique_ranks = array("H", [0]) * (1 << 13)
+    products = {}
+    for cards, rank in zip(hands, ranks):
+        rank_mask = get_rank_mask(cards)
+        if cards[0] & cards[1] & cards[2] & cards[3] & cards[4] & CARD_SUITS_MASK:
+            flushes[rank_mask] = class_ids[rank]
+        elif bin(rank_mask).count("1") == 5:
+            unique_ranks[rank_mask] = class_ids[rank]
+        else:
+            products[get_prime_product(cards)] = class_ids[rank]
+
+    return {
+        "version": RANK_TABLES_VERSION,
+        "flushes": flushes,
+        "unique_ranks": unique_ranks,
+        "products": products,
+    }
+
+
+def read_rank_tables(path=RANK_TABLES_PATH):
+    """Читает таблицы с диска. Массивы должны быть ровно по 2^13 элементов,
+    а каждый класс от 1 до HAND_CLASSES - ровно в одной из таблиц, иначе
+    ValueError"""
+    tables = {}
+    for name in RANK_TABLES_ARRAYS:
+        with open("{}.{}".format(path, name), "rb") as table_file:
+            table = array("H")
+            table.fromfile(table_file, 1 << 13)
+            if table_file.read(1):
+                raise ValueError("{} table is too long".format(name))
+        tables[name] = table
+
+    with open(path + ".products.json") as products_file:
+        data = json.load(products_file)
+    if data["version"] != RANK_TABLES_VERSION:
+        raise ValueError("Rank tables version {}".format(data["version"]))
+    tables["version"] = data["version"]
+    tables["products"] = {
+        int(product): class_id for product, class_id in data["products"]
+    }
+
+    class_ids = [
+        class_id for name in RANK_TABLES_ARRAYS for class_id in tables[name] if class_id
+    ]
+    class_ids.extend(tables["products"].values())
+    if sorted(class_ids) != list(range(1, HAND_CLASSES + 1)):
+        raise ValueError("Rank tables don't cover hand classes")
+
+    return tables
+
+
+def write_rank_tables(tables, path=RANK_TABLES_PATH):
+    """Каждый файл пишется во временный и подменяется целиком"""
+    tmp_suffix = ".{}.tmp".format(os.getpid())
+    for name in RANK_TABLES_ARRAYS:
+        table_path = "{}.{}".format(path, name)
+        with open(table_path + tmp_suffix, "wb") as table_file:
+            tables[name].tofile(table_file)
+        os.replace(table_path + tmp_suffix, table_path)
+
+    products_path = path + ".products.json"
+    with open(products_path + tmp_suffix, "w") as products_file:
+        json.dump(
+            {
+                "version": tables["version"],
+                "products": sorted(tables["products"].items()),
+            },
+            products_file,
+        )
+    os.replace(products_path + tmp_suffix, products_path)
+
+
+def load_rank_tables(path=RANK_TABLES_PATH):
+    """Загружает таблицы с диска, если их там нет или они повреждены -
+    создает и сохраняет"""
+    try:
+        return read_rank_tables(path)
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        pass
+
+    tables = build_rank_tables()
+    try:
+        write_rank_tables(tables, path)
+    except OSError:
+        # без записи на диск таблицы просто будут созданы заново
+        pass
+
+    return tables
+
+
+_rank_tables = None
+
+
+def get_rank_tables():
+    """Таблицы загружаются при первом вызове, а не при импорте"""
+    global _rank_tables
+    if _rank_tables is None:
+        _rank_tables = load_rank_tables()
+    return _rank_tables
+
+
+def hand_rank_table(cards):
+    """Возвращает номер класса 'руки' из 5ти карт от 1 до 7462 (см.
+    encode_card). Номера сравниваются так же, как значения hand_rank"""
+    tables = _rank_tables or get_rank_tables()
+    c1, c2, c3, c4, c5 = cards
+    rank_mask = (c1 | c2 | c3 | c4 | c5) >> RANK_MASK_SHIFT
+
+    if c1 & c2 & c3 & c4 & c5 & CARD_SUITS_MASK:
+        return tables["flushes"][rank_mask]
+
+    class_id = tables["unique_ranks"][rank_mask]
+    if class_id:
+        return class_id
+
+    return tables["products"][
+        (c1 >> CARD_PRIME_SHIFT & CARD_PRIME_MASK)
+        * (c2 >> CARD_PRIME_SHIFT & CARD_PRIME_MASK)
+        * (c3 >> CARD_PRIME_SHIFT & CARD_PRIME_MASK)
+        * (c4 >> CARD_PRIME_SHIFT & CARD_PRIME_MASK)
+        * (c5 >> CARD_PRIME_SHIFT & CARD_PRIME_MASK)
+    ]
+
+
+def pack_ranks(ranks):
+    """Упаковывает 5 рангов по возрастанию так же, как hand_rank_bits"""
+    a, b, c, d, e = sorted(ranks)
+    return a << 16 | b << 12 | c << 8 | d << 4 | e
+
+
+def get_straight_high(rank_mask):
+    """Старший ранг лучшего стрита в маске рангов (бит на ранг), иначе 0.
+    Как и в hand_rank, туз не бывает младшей картой стрита"""
+    for high in range(14, 5, -1):
+        if rank_mask >> (high - 4) & 0b11111 == 0b11111:
+            return high
+    return 0
+
+
+def evaluate_7(cards):
+    """Возвращает ранг лучшей 'руки' из 5ти карт среди 7ми карт (см.
+    encode_card) как hand_rank_bits и индексы этих карт по возрастанию.
+    Категория и кикеры находятся по количеству карт каждого ранга и
+    масти, без перебора 21 комбинации. Из карт одного ранга берутся
+    первые, поэтому выбор совпадает с best_hand"""
+    by_rank = {}
+    by_suit = {}
+    for i, card in enumerate(cards):
+        by_rank.setdefault(card & CARD_RANK_MASK, []).append(i)
+        by_suit.setdefault(card & CARD_SUITS_MASK, []).append(i)
+
+    flush = None
+    for suit_indexes in by_suit.values():
+        if len(suit_indexes) >= 5:
+            # у карт одной масти ранги разные
+            flush = {cards[i] & CARD_RANK_MASK: i for i in suit_indexes}
+            flush_mask = 0
+            for rank in flush:
+                flush_mask |= 1 << rank
+            high = get_straight_high(flush_mask)
+            if high:
+                indexes = [flush[rank] for rank in range(high - 4, high + 1)]
+                return 8 << HAND_CATEGORY_SHIFT | high << 24, tuple(sorted(indexes))
+
+    ranks = sorted(by_rank, reverse=True)
+    quads = [rank for rank in ranks if len(by_rank[rank]) == 4]
+    trips = [rank for rank in ranks if len(by_rank[rank]) == 3]
+    pairs = [rank for rank in ranks if len(by_rank[rank]) == 2]
+
+    if quads:
+        quad = quads[0]
+        kicker = next(rank for rank in ranks if rank != quad)
+        indexes = by_rank[quad] + by_rank[kicker][:1]
+        value = 7 << HAND_CATEGORY_SHIFT | quad << 24 | kicker << 20
+    elif trips and (len(trips) > 1 or pairs):
+        trip = trips[0]
+        pair = max(trips[1:] + pairs)
+        indexes = by_rank[trip] + by_rank[pair][:2]
+        value = 6 << HAND_CATEGORY_SHIFT | trip << 24 | pair << 20
+    elif flush is not None:
+        top = sorted(flush, reverse=True)[:5]
+        indexes = [flush[rank] for rank in top]
+        value = 5 << HAND_CATEGORY_SHIFT | pack_ranks(top) << 8
+    else:
+        rank_mask = 0
+        for rank in ranks:
+            rank_mask |= 1 << rank
+        high = get_straight_high(rank_mask)
+
+        if high:
+            indexes = [by_rank[rank][0] for rank in range(high - 4, high + 1)]
+            value = 4 << HAND_CATEGORY_SHIFT | high << 24
+        elif trips:
+            trip = trips[0]
+            kickers = [rank for rank in ranks if rank != trip][:2]
+            indexes = by_rank[trip] + [by_rank[rank][0] for rank in kickers]
+            value = (
+                3 << HAND_CATEGORY_SHIFT
+                | trip << 24
+                | pack_ranks([trip] * 3 + kickers) << 4
+            )
+        elif len(pairs) > 1:
+            # из трех пар лучше две старшие
+            high_pair, low_pair = pairs[:2]
+            kicker = next(rank for rank in ranks if rank not in (high_pair, low_pair))
+            indexes = by_rank[high_pair] + by_rank[low_pair] + by_rank[kicker][:1]
+            value = (
+                2 << HAND_CATEGORY_SHIFT
+                | low_pair << 24
+                | high_pair << 20
+                | pack_ranks([high_pair] * 2 + [low_pair] * 2 + [kicker])
+            )
+        elif pairs:
+            pair = pairs[0]
+            kickers = [rank for rank in ranks if rank != pair][:3]
+            indexes = by_rank[pair] + [by_rank[rank][0] for rank in kickers]
+            value = (
+                1 << HAND_CATEGORY_SHIFT
+                | pair << 24
+                | pack_ranks([pair] * 2 + kickers) << 4
+            )
+        else:
+            top = ranks[:5]
+            indexes = [by_rank[rank][0] for rank in top]
+            value = pack_ranks(top) << 8
+
+    return value, tuple(sorted(indexes))
+
+
+def best_hand_ranked(hand):
+    """Возвращает ранг (как hand_rank_bits) и лучшую 'руку' из 5ти карт,
+    ту же, что и best_hand, но без перебора комбинаций"""
+    value, indexes = evaluate_7(encode_hand(hand))
+    return value, tuple(hand[i] for i in indexes)
+
+
 def best_wild_hand(hand):
     """best_hand но с джокерами"""
     return
@@ -235,6 +641,79 @@ def test_best_hand():
     print("OK")
 
 
+def test_hand_rank_bits():
+    print("test_hand_rank_bits...")
+    deck = [rank + suit for rank in RANKS_MAPPING for suit in SUITS]
+    rng = random.Random(0)
+    hands = [tuple(rng.sample(deck, 5)) for _ in range(20000)]
+    hands += [
+        tuple("6C 7C 8C 9C TC".split()),
+        tuple("TD TC TH 8C 8S".split()),
+        tuple("7C 7D 7H 7S JD".split()),
+        tuple("2C 3D 4H 5S 6D".split()),
+        tuple("2C 2D 4H 4S 6D".split()),
+    ]
+
+    ranked = sorted(
+        (hand_rank(hand), hand_rank_bits(encode_hand(hand))) for hand in hands
+    )
+    for (rank, bits), (next_rank, next_bits) in zip(ranked, ranked[1:]):
+        assert (bits < next_bits) if rank < next_rank else (bits == next_bits)
+
+    for _ in range(2000):
+        hand = rng.sample(deck, 7)
+        assert best_hand_bits(hand) == best_hand(hand)
+    print("OK")
+
+
+def test_hand_rank_table():
+    print("test_hand_rank_table...")
+    tables = build_rank_tables()
+    assert len(set(tables["products"].values())) == 4888
+    assert max(tables["flushes"]) == HAND_CLASSES
+
+    deck = [rank + suit for rank in RANKS_MAPPING for suit in SUITS]
+    rng = random.Random(1)
+    hands = [encode_hand(rng.sample(deck, 5)) for _ in range(20000)]
+    ranked = sorted((hand_rank_bits(cards), hand_rank_table(cards)) for cards in hands)
+    for (bits, class_id), (next_bits, next_class_id) in zip(ranked, ranked[1:]):
+        assert (
+            (class_id < next_class_id)
+            if bits < next_bits
+            else (class_id == next_class_id)
+        )
+
+    for _ in range(2000):
+        hand = rng.sample(deck, 7)
+        assert best_hand_bits(hand, hand_rank_table) == best_hand(hand)
+    print("OK")
+
+
+def test_best_hand_ranked():
+    print("test_best_hand_ranked...")
+    for hand in (
+        "6C 7C 8C 9C TC 5C JS",
+        "TD TC TH 7C 7D 8C 8S",
+        "JD TC TH 7C 7D 7S 7H",
+        "AC 2D 3H 4S 5C 9D KH",
+        "2C 2D 5H 5S 9C 9D KH",
+        "2C 5C 7C 9C JC KC AC",
+    ):
+        hand = hand.split()
+        value, best = best_hand_ranked(hand)
+        assert best == best_hand(hand)
+        assert value == hand_rank_bits(encode_hand(best))
+
+    deck = [rank + suit for rank in RANKS_MAPPING for suit in SUITS]
+    rng = random.Random(2)
+    for _ in range(5000):
+        hand = rng.sample(deck, 7)
+        value, best = best_hand_ranked(hand)
+        assert best == best_hand(hand)
+        assert value == hand_rank_bits(encode_hand(best))
+    print("OK")
+
+
 def test_best_wild_hand():
     print("test_best_wild_hand...")
     assert sorted(best_wild_hand("6C 7C 8C 9C TC 5C ?B".split())) == [
@@ -269,3 +748,6 @@ if __name__ == "__main__":
     test_kind()
     test_two_pair()
     test_best_hand()
+    test_hand_rank_bits()
+    test_hand_rank_table()
+    test_best_hand_ranked()
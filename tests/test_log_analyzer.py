@@ -5,10 +5,70 @@ from src.log_analyzer import (
     parse_log_record,
     create_report,
     get_latest_log_info,
+    UrlStats,
+    aggregate_records,
+    build_report,
+    split_file_ranges,
+    get_log_aggregate_parallel,
+    aggregate_buffer,
+    ExactQuantiles,
+    LogHistogramQuantiles,
+    get_quantile_factory,
+    LogAggregate,
+    get_log_aggregate_incremental,
+    get_complete_lines_end,
+    get_log_files_info,
+    backfill,
+    config,
+    read_gzip_chunks,
+    get_aggregate_settings,
+    get_aggregate_factory,
+    UrlNormalizer,
+    OTHER_URL,
+    np,
+    write_parsed_cache,
+    aggregate_parsed_cache,
+    is_parsed_cache_valid,
+    build_log_report,
+    load_rollup_aggregate,
+    rollup,
+    render_template,
+    RollingWindows,
+    follow_log_lines,
+    follow,
+    probe_log_format,
+    check_errors_limit,
+    parse_log_fields,
+    get_parser,
+    GroupedLogAggregate,
+    build_group_reports,
+    save_report,
 )
+from benchmarks.loggen import generate_log
+from functools import partial
+import pickle
+from statistics import median, quantiles
+import random
+import gzip
+import os
+import tempfile
+import threading
+import time
+import json
+from string import Template
 
 
 class TestLogAnalyzer(unittest.TestCase):
+    def assertReportsAlmostEqual(self, first, second):
+        self.assertEqual(len(first), len(second))
+        for first_line, second_line in zip(first, second):
+            self.assertEqual(first_line.keys(), second_line.keys())
+            for key, value in first_line.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(value, second_line[key])
+                else:
+                    self.assertEqual(value, second_line[key])
+
     def test_is_gzip_file_recognize_gz(self):
         file = "somefile.gz"
         res = is_gzip_file(file)
@@ -21,38 +81,286 @@ class TestLogAnalyzer(unittest.TestCase):
 
     def test_get_log_recors_return_recors_correctly(self):
         log_path = "tests/data/logs/nginx-access-ui.log-20180320.gz"
-        res = get_log_records(log_path, parse_log_record)
+        res = list(get_log_records(log_path, parse_log_record))
         self.assertEqual(len(res), 6)
 
     def test_get_log_recors_raise_error_when_errors_limit_reached(self):
         log_path = "tests/data/logs/nginx-access-ui.log-20180321.gz"
         errors_limit = 0.1
         with self.assertRaises(RuntimeError):
-            get_log_records(log_path, parse_log_record, errors_limit)
+            list(get_log_records(log_path, parse_log_record, errors_limit))
 
     def test_get_log_recors_return_recors_correctly_when_errors(self):
         log_path = "tests/data/logs/nginx-access-ui.log-20180321.gz"
         errors_limit = 0.5
-        res = get_log_records(log_path, parse_log_record, errors_limit)
+        res = list(get_log_records(log_path, parse_log_record, errors_limit))
         self.assertEqual(len(res), 4)
 
+    def test_get_log_records_abort_after_errors_warmup(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180322.gz")
+            with gzip.open(log_path, "wb") as log_file:
+                log_file.writelines(b"not a log line\n" for _ in range(100000))
+
+            records = get_log_records(log_path, parse_log_record, 0.5, errors_warmup=10)
+            with self.assertRaises(RuntimeError):
+                next(records)
+
+            aggregate = LogAggregate()
+            with self.assertRaises(RuntimeError):
+                get_log_aggregate_parallel(
+                    log_path, parse_log_record, 0.5, 2, errors_warmup=10
+                )
+            with self.assertRaises(RuntimeError):
+                with gzip.open(log_path) as log_file:
+                    aggregate_buffer(
+                        log_file.read(),
+                        parse_log_record,
+                        aggregate=aggregate,
+                        errors_limit=0.5,
+                        errors_warmup=10,
+                    )
+            self.assertEqual(aggregate.errors, 10)
+
+            # without a limit the whole log is read
+            self.assertEqual(list(get_log_records(log_path, parse_log_record)), [])
+
+    def test_errors_near_log_start_dont_abort_valid_log(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            generated_path = generate_log(tmp_dir, 5000, compress=False)
+            with open(generated_path, "rb") as log_file:
+                lines = log_file.readlines()
+            os.remove(generated_path)
+
+            # 20 broken lines on top and 200 right after the warmup,
+            # 220 errors of 5220 lines are under the limit in the whole log
+            bad_lines = [b"<html>\n"] * 20 + lines[:1000] + [b"<html>\n"] * 200
+            data = b"".join(bad_lines + lines[1000:])
+            logs_info = []
+            for file_date, log_open in (("20180322", open), ("20180323", gzip.open)):
+                log_info = {
+                    "file_date": file_date,
+                    "name": "nginx-access-ui.log-" + file_date,
+                }
+                if log_open is gzip.open:
+                    log_info["name"] += ".gz"
+                with log_open(os.path.join(tmp_dir, log_info["name"]), "wb") as f:
+                    f.write(data)
+                logs_info.append(log_info)
+
+            for workers in (1, 2):
+                conf = dict(
+                    config,
+                    LOG_DIR=tmp_dir,
+                    REPORT_DIR=tmp_dir,
+                    ERRORS_LIMIT=0.1,
+                    WORKERS=workers,
+                )
+                for log_info in logs_info:
+                    stats = build_log_report(log_info, conf)
+                    self.assertEqual(stats["errors"], 220)
+                    os.remove(stats["report"])
+
+            # a plain log fails as soon as the rest of it can't bring the
+            # errors back under the limit, before it's read in full
+            plain_path = os.path.join(tmp_dir, logs_info[0]["name"])
+            with open(plain_path, "wb") as log_file:
+                for line in lines:
+                    log_file.write(line + b"<html>\n")
+            records = get_log_records(plain_path, parse_log_record, 0.1)
+            parsed = 0
+            with self.assertRaises(RuntimeError):
+                for _ in records:
+                    parsed += 1
+            self.assertLess(parsed, len(lines))
+
+    def test_check_errors_limit_without_records(self):
+        check_errors_limit(0, 0, 0.1)
+        check_errors_limit(5, 0, None)
+        with self.assertRaises(RuntimeError):
+            check_errors_limit(5, 0, 0.1)
+
+    def test_probe_log_format(self):
+        probe_log_format(
+            "tests/data/logs/nginx-access-ui.log-20180321.gz", parse_log_record, 0.5
+        )
+        with self.assertRaises(RuntimeError):
+            probe_log_format(
+                "tests/data/logs/nginx-access-ui.log-20180321.gz",
+                parse_log_record,
+                0.1,
+            )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180322")
+            with open(log_path, "wb") as log_file:
+                log_file.write(b"<html>\n" * 10)
+            conf = dict(config, LOG_DIR=tmp_dir, REPORT_DIR=tmp_dir, ERRORS_LIMIT=0.1)
+            log_info = {"file_date": "20180322", "name": "nginx-access-ui.log-20180322"}
+
+            with self.assertRaisesRegex(RuntimeError, "format"):
+                build_log_report(log_info, conf)
+            self.assertEqual(os.listdir(tmp_dir), ["nginx-access-ui.log-20180322"])
+
+            # a log corrupted by a crash, filled with zeros and without newlines
+            zeros_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180323")
+            with open(zeros_path, "wb") as log_file:
+                log_file.truncate(256 * 1024 * 1024)
+            with self.assertRaisesRegex(RuntimeError, "100 of first 100"):
+                probe_log_format(zeros_path, parse_log_record, 0.1)
+
+    def test_parse_log_fields(self):
+        line = (
+            b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 '
+            b'HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708" '
+            b'"dc7161be3" 0.390'
+        )
+        self.assertEqual(
+            parse_log_fields(
+                line, fields=("hour", "status", "method", "body_bytes_sent")
+            ),
+            ("/api/v2/banner/25019354", 0.39, ("2017-06-29 03:00", 200, "GET", 927)),
+        )
+        self.assertIsNone(parse_log_fields(b"broken line", fields=("status",)))
+
+    def test_grouped_aggregate_matches_separate_groupings(self):
+        group_by = [["status"], ["method", "hour"]]
+        parse = get_parser("regex", group_by)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = generate_log(tmp_dir, 3000, urls=100, error_rate=0.01)
+            records = list(get_log_records(log_path, parse))
+
+        aggregate = aggregate_records(records, partial(GroupedLogAggregate, group_by))
+        self.assertReportsAlmostEqual(
+            build_report(aggregate),
+            build_report(aggregate_records(record[:2] for record in records)),
+        )
+
+        reports = build_group_reports(aggregate)
+        self.assertEqual(sorted(reports), ["method,hour", "status"])
+        by_status = {}
+        for _, _, (status, method, hour, body_bytes_sent) in records:
+            count, bytes_sum = by_status.get(status, (0, 0))
+            by_status[status] = count + 1, bytes_sum + body_bytes_sent
+        self.assertEqual(
+            {
+                line["status"]: (line["count"], line["bytes_sum"])
+                for line in reports["status"]
+            },
+            by_status,
+        )
+        self.assertEqual(
+            sum(line["count"] for line in reports["method,hour"]), len(records)
+        )
+
+        # partial aggregates, saved or pickled by workers, give the same groups
+        merged = GroupedLogAggregate(group_by)
+        merged.merge(
+            pickle.loads(
+                pickle.dumps(
+                    aggregate_records(
+                        records[:1000], partial(GroupedLogAggregate, group_by)
+                    )
+                )
+            )
+        )
+        merged.load(
+            json.loads(
+                json.dumps(
+                    aggregate_records(
+                        records[1000:], partial(GroupedLogAggregate, group_by)
+                    ).to_dict()
+                )
+            )
+        )
+        merged_reports = build_group_reports(merged)
+        self.assertEqual(merged_reports.keys(), reports.keys())
+        for name, report in reports.items():
+            self.assertReportsAlmostEqual(merged_reports[name], report)
+
+    def test_build_log_report_saves_group_reports(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            generate_log(tmp_dir, 2000, file_date="20180322", compress=False)
+            log_info = {"file_date": "20180322", "name": "nginx-access-ui.log-20180322"}
+            groups_path = os.path.join(tmp_dir, "report-2018.03.22.groups.json")
+
+            group_reports = []
+            for workers in (1, 2):
+                conf = dict(
+                    config,
+                    LOG_DIR=tmp_dir,
+                    REPORT_DIR=tmp_dir,
+                    WORKERS=workers,
+                    GROUP_BY=[["status"], ["hour"]],
+                )
+                build_log_report(log_info, conf)
+                with open(groups_path) as groups_file:
+                    group_reports.append(json.load(groups_file))
+                os.remove(os.path.join(tmp_dir, "report-2018.03.22.html"))
+
+        self.assertReportsAlmostEqual(
+            group_reports[0]["status"], group_reports[1]["status"]
+        )
+        self.assertEqual(len(group_reports[0]["hour"]), 24)
+
     def test_parse_log_record(self):
-        log = '1.199.4.96 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/slot/4705/groups HTTP/1.1" 200 2613 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-3800516057-4708-9752745" "2a828197ae235b0b3cb" 0.704'  # noqa: E501
+        log = b'1.199.4.96 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/slot/4705/groups HTTP/1.1" 200 2613 "-" "Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-3800516057-4708-9752745" "2a828197ae235b0b3cb" 0.704'  # noqa: E501
         parsed_log = parse_log_record(log)
         self.assertEqual(parsed_log, ("/api/v2/slot/4705/groups", 0.704))
 
     def test_parse_log_record_when_wrong_format(self):
-        log = '1200 2613 "516057-4708-9752745" "2a828197ae235b0b3cb" '
+        log = b'1200 2613 "516057-4708-9752745" "2a828197ae235b0b3cb" '
         parsed_log = parse_log_record(log)
         self.assertEqual(parsed_log, None)
 
+        line = (
+            b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/1 '
+            b'HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708" '
+            b'"dc7161be3" 0.390\n'
+        )
+        for log in (
+            b'junk "GET /x HTTP/1.1" 0.5',
+            b'"a b c" 1.0',
+            line.replace(b" 200 ", b" OK "),
+            line.replace(b" 927 ", b" - "),
+            line.replace(b"[29/Jun/2017:03:50:22 +0300] ", b""),
+            line.replace(b'"-" "Lynx', b'"Lynx'),
+        ):
+            self.assertIsNone(parse_log_record(log))
+
+    def test_parse_log_record_parses_line_in_place(self):
+        with gzip.open("tests/data/logs/nginx-access-ui.log-20180321.gz") as log_file:
+            lines = log_file.read().splitlines(keepends=True)
+        buf = b"".join(lines)
+
+        start = 0
+        for line in lines:
+            end = start + len(line)
+            self.assertEqual(parse_log_record(buf, start, end), parse_log_record(line))
+            start = end
+
+    def test_get_log_records_reads_plain_file(self):
+        with gzip.open("tests/data/logs/nginx-access-ui.log-20180321.gz") as log_file:
+            data = log_file.read()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180321")
+            with open(log_path, "wb") as plain_file:
+                plain_file.write(data)
+            empty_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180322")
+            open(empty_path, "wb").close()
+
+            res = list(get_log_records(log_path, parse_log_record, 0.5))
+            self.assertEqual(len(res), 4)
+            self.assertEqual(list(get_log_records(empty_path, parse_log_record)), [])
+
     def test_create_report(self):
         records = [
             ("/api/v2/banner/25019354", 0.39),
             ("/api/1/photogenic_banners/list/?server_name=WIN7RB4", 0.133),
         ]
-        max_records = 5
-        report_lines = create_report(records, max_records)
+        max_urls = 5
+        report_lines = create_report(records, max_urls)
         expected_records = [
             {
                 "href": "/api/v2/banner/25019354",
@@ -63,6 +371,9 @@ class TestLogAnalyzer(unittest.TestCase):
                 "time_avg": 0.39,
                 "time_max": 0.39,
                 "time_med": 0.39,
+                "time_p90": 0.39,
+                "time_p95": 0.39,
+                "time_p99": 0.39,
             },
             {
                 "href": "/api/1/photogenic_banners/list/?server_name=WIN7RB4",
@@ -73,10 +384,470 @@ class TestLogAnalyzer(unittest.TestCase):
                 "time_avg": 0.133,
                 "time_max": 0.133,
                 "time_med": 0.133,
+                "time_p90": 0.133,
+                "time_p95": 0.133,
+                "time_p99": 0.133,
             },
         ]
         self.assertEqual(report_lines, expected_records)
 
+    def test_create_report_keeps_top_urls_by_time_sum(self):
+        records = [("/a", 0.1), ("/b", 0.5), ("/c", 0.3), ("/a", 0.1), ("/d", 0.0)]
+        report_lines = create_report(records, 2)
+
+        self.assertEqual([line["href"] for line in report_lines], ["/b", "/c"])
+        self.assertEqual(report_lines[0]["count_perc"], 20.0)
+        self.assertAlmostEqual(report_lines[0]["time_perc"], 50.0)
+
+    def test_url_stats_median_matches_statistics_median(self):
+        for times in (
+            [0.5],
+            [0.3, 0.1],
+            [0.2, 0.2, 0.7, 0.1],
+            [0.4, 0.1, 0.4, 0.9, 0.3],
+        ):
+            url_stats = UrlStats()
+            for response_time in times:
+                url_stats.add(response_time)
+            self.assertEqual(url_stats.median(), median(times))
+
+    def test_url_stats_merge(self):
+        left, right = UrlStats(), UrlStats()
+        for response_time in (0.1, 0.5):
+            left.add(response_time)
+        for response_time in (0.3, 0.9, 0.2):
+            right.add(response_time)
+        left.merge(right)
+        self.assertEqual(left.count, 5)
+        self.assertEqual(left.time_max, 0.9)
+        self.assertEqual(left.median(), 0.3)
+
+    def test_aggregate_records_consumes_generator(self):
+        records = (("/a", t) for t in (0.1, 0.2, 0.3))
+        aggregate = aggregate_records(records)
+        self.assertEqual(aggregate.total_records, 3)
+        self.assertEqual(list(aggregate.urls), ["/a"])
+
+    def test_exact_quantiles_match_statistics_quantiles(self):
+        times = [0.1, 0.7, 0.3, 0.3, 0.9, 0.2, 0.5]
+        exact = ExactQuantiles()
+        for response_time in times:
+            exact.add(response_time)
+
+        expected = quantiles(times, n=100, method="inclusive")
+        for percentile in (10, 50, 90, 95, 99):
+            self.assertAlmostEqual(
+                exact.quantile(percentile / 100.0), expected[percentile - 1]
+            )
+
+    def test_log_histogram_quantiles_within_accuracy(self):
+        rnd = random.Random(42)
+        times = sorted(round(rnd.expovariate(5), 3) for _ in range(5000))
+        left, right = LogHistogramQuantiles(0.01), LogHistogramQuantiles(0.01)
+        for i, response_time in enumerate(times):
+            (left if i % 2 else right).add(response_time)
+        left.merge(right)
+
+        exact_quantiles = ExactQuantiles()
+        for response_time in times:
+            exact_quantiles.add(response_time)
+
+        self.assertEqual(left.count, len(times))
+        for q in (0.5, 0.9, 0.95, 0.99):
+            exact = exact_quantiles.quantile(q)
+            self.assertLessEqual(abs(left.quantile(q) - exact), 0.01 * exact)
+
+        # few samples, where ranks' values are far from each other
+        rnd = random.Random(60)
+        few_times = [round(rnd.expovariate(5), 3) for _ in range(60)]
+        sketch, exact_quantiles = LogHistogramQuantiles(0.01), ExactQuantiles()
+        for response_time in few_times:
+            sketch.add(response_time)
+            exact_quantiles.add(response_time)
+        for q in (0.5, 0.9, 0.95, 0.99):
+            exact = exact_quantiles.quantile(q)
+            self.assertLessEqual(abs(sketch.quantile(q) - exact), 0.01 * exact)
+
+    def test_log_histogram_quantiles_merge_different_accuracy(self):
+        with self.assertRaises(ValueError):
+            LogHistogramQuantiles(0.01).merge(LogHistogramQuantiles(0.05))
+
+    def test_create_report_with_histogram_quantiles(self):
+        records = [("/a", 0.2), ("/a", 0.4), ("/a", 0.0)]
+        aggregate = aggregate_records(
+            records, partial(LogAggregate, get_quantile_factory("histogram", 0.01))
+        )
+        report_line = build_report(aggregate)[0]
+        self.assertAlmostEqual(report_line["time_med"], 0.2, delta=0.002)
+        # interpolated between 0.2 and 0.4 like exact quantiles
+        self.assertAlmostEqual(report_line["time_p99"], 0.396, delta=0.004)
+
+    def test_split_file_ranges_aligned_on_newlines(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "log")
+            with open(log_path, "wb") as log_file:
+                log_file.write(b"first line\nsecond\nthird line here\nlast")
+
+            ranges = split_file_ranges(log_path, 3)
+            with open(log_path, "rb") as log_file:
+                data = log_file.read()
+
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for start, end in ranges:
+            self.assertTrue(start == 0 or data.endswith(b"\n", 0, start))
+        self.assertEqual(b"".join(data[s:e] for s, e in ranges), data)
+
+    def test_get_log_aggregate_parallel_matches_sequential(self):
+        gz_path = "tests/data/logs/nginx-access-ui.log-20180321.gz"
+        with gzip.open(gz_path) as gz_file:
+            data = gz_file.read()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            plain_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180321")
+            with open(plain_path, "wb") as plain_file:
+                plain_file.write(data)
+
+            sequential = build_report(
+                aggregate_records(get_log_records(gz_path, parse_log_record))
+            )
+            for log_path in (gz_path, plain_path):
+                aggregate = get_log_aggregate_parallel(
+                    log_path, parse_log_record, 0.5, 3
+                )
+                self.assertEqual(aggregate.errors, 2)
+                self.assertEqual(build_report(aggregate), sequential)
+
+    def test_get_log_aggregate_parallel_raise_error_when_errors_limit_reached(self):
+        log_path = "tests/data/logs/nginx-access-ui.log-20180321.gz"
+        with self.assertRaises(RuntimeError):
+            get_log_aggregate_parallel(log_path, parse_log_record, 0.1, 2)
+
+    def test_log_aggregate_to_dict_load_roundtrip(self):
+        records = [("/a", 0.2), ("/b", 0.5), ("/a", 0.3)]
+        for quantile_factory in (
+            get_quantile_factory("exact"),
+            get_quantile_factory("histogram", 0.01),
+        ):
+            aggregate = aggregate_records(
+                records, partial(LogAggregate, quantile_factory)
+            )
+            loaded = LogAggregate(quantile_factory)
+            loaded.load(aggregate.to_dict())
+            self.assertEqual(build_report(loaded), build_report(aggregate))
+
+    def test_url_normalizer(self):
+        normalizer = UrlNormalizer([[r"/\d+(?=/|$)", "/{id}"]])
+        self.assertEqual(normalizer("/api/v2/banner/23815685"), "/api/v2/banner/{id}")
+        self.assertEqual(
+            normalizer("/api/v2/slot/4705/groups?x=1"), "/api/v2/slot/{id}/groups"
+        )
+        self.assertEqual(normalizer("/api/v2"), "/api/v2")
+
+        restored = pickle.loads(pickle.dumps(normalizer))
+        self.assertEqual(restored("/api/1/banners/?q=2"), "/api/{id}/banners/")
+
+    def test_aggregate_collapses_urls_and_folds_long_tail(self):
+        records = [
+            ("/api/v2/banner/1", 0.1),
+            ("/api/v2/banner/2?a=1", 0.2),
+            ("/api/v2/slot/3/groups", 0.3),
+        ]
+        # unique URLs sprayed before a real route comes
+        records += [("/spam-{}".format(i), 0.01) for i in range(10)]
+        records += [("/api/v2/internal/info", 0.4)] * 3
+
+        backends = ["python"] + (["numpy"] if np is not None else [])
+        for backend in backends:
+            settings = get_aggregate_settings(
+                dict(
+                    config, URL_NORMALIZE=True, MAX_URLS=4, AGGREGATION_BACKEND=backend
+                )
+            )
+            factory = get_aggregate_factory(settings)
+            aggregate = aggregate_records(records, factory)
+
+            self.assertEqual(
+                list(aggregate.urls),
+                [
+                    "/api/v2/banner/{id}",
+                    "/api/v2/slot/{id}/groups",
+                    OTHER_URL,
+                    "/api/v2/internal/info",
+                ],
+            )
+            self.assertEqual(aggregate.urls["/api/v2/banner/{id}"].count, 2)
+            self.assertEqual(aggregate.urls["/api/v2/internal/info"].count, 3)
+            self.assertEqual(aggregate.urls[OTHER_URL].count, 10)
+            self.assertEqual(aggregate.total_records, 16)
+
+            # merged parts keep the same URLs whatever order they come in
+            first = aggregate_records(records[:8], factory)
+            second = aggregate_records(records[8:], factory)
+            first.merge(aggregate_records(records[8:], factory))
+            second.merge(aggregate_records(records[:8], factory))
+            for merged in (first, second):
+                self.assertEqual(len(merged.urls), 4)
+                self.assertEqual(set(merged.urls), set(aggregate.urls))
+                self.assertEqual(
+                    sum(url_stats.count for url_stats in merged.urls.values()), 16
+                )
+
+            only_other = aggregate_records(
+                records, get_aggregate_factory(dict(settings, max_urls=1))
+            )
+            self.assertEqual(list(only_other.urls), [OTHER_URL])
+            self.assertEqual(only_other.urls[OTHER_URL].count, 16)
+
+    @unittest.skipIf(np is None, "numpy is not installed")
+    def test_numpy_backend_matches_python_backend(self):
+        rnd = random.Random(7)
+        records = [
+            ("/api/{}".format(rnd.randint(0, 20)), round(rnd.expovariate(3), 3))
+            for _ in range(3000)
+        ]
+        python_factory = get_aggregate_factory(get_aggregate_settings(config))
+        numpy_factory = get_aggregate_factory(
+            get_aggregate_settings(dict(config, AGGREGATION_BACKEND="numpy"))
+        )
+
+        expected = build_report(aggregate_records(records, python_factory))
+        numpy_aggregate = aggregate_records(records, numpy_factory)
+        self.assertReportsAlmostEqual(build_report(numpy_aggregate), expected)
+
+        merged = aggregate_records(records[:1000], numpy_factory)
+        merged.merge(aggregate_records(records[1000:2000], numpy_factory))
+        loaded = numpy_factory()
+        saved = aggregate_records(records[2000:], numpy_factory).to_dict()
+        loaded.load(json.loads(json.dumps(saved)))
+        merged.merge(loaded)
+        self.assertReportsAlmostEqual(build_report(merged), expected)
+
+        # saved state grows with distinct (href, time) pairs, not with records
+        self.assertEqual(len(saved["times"]), len(set(records[2000:])))
+        self.assertEqual(sum(saved["counts"]), 1000)
+        # and so does loaded state, pairs are reduced with counts as weights
+        self.assertEqual(len(loaded.times), len(saved["times"]))
+        for record in records[:100]:
+            loaded.add(*record)
+        resaved = numpy_factory()
+        resaved.load(loaded.to_dict())
+        self.assertEqual(resaved.total_records, 1100)
+        self.assertReportsAlmostEqual(
+            build_report(resaved),
+            build_report(aggregate_records(records[2000:] + records[:100])),
+        )
+        empty = numpy_factory()
+        empty.load(numpy_factory().to_dict())
+        self.assertEqual(build_report(empty), [])
+
+    def test_parsed_cache_roundtrip(self):
+        log_path = "tests/data/logs/nginx-access-ui.log-20180321.gz"
+        factories = [get_aggregate_factory(get_aggregate_settings(config))]
+        if np is not None:
+            factories.append(
+                get_aggregate_factory(
+                    get_aggregate_settings(dict(config, AGGREGATION_BACKEND="numpy"))
+                )
+            )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, "cache", "log.parsed")
+            counters = {}
+            records = get_log_records(
+                log_path, parse_log_record, None, counters=counters
+            )
+            expected = aggregate_records(
+                write_parsed_cache(cache_path, records, os.stat(log_path), counters)
+            )
+
+            self.assertTrue(is_parsed_cache_valid(cache_path, log_path))
+            self.assertFalse(
+                is_parsed_cache_valid(
+                    cache_path, "tests/data/logs/nginx-access-ui.log-20180320.gz"
+                )
+            )
+            for aggregate_factory in factories:
+                aggregate = aggregate_parsed_cache(cache_path, aggregate_factory)
+                self.assertEqual(aggregate.errors, 2)
+                self.assertReportsAlmostEqual(
+                    build_report(aggregate), build_report(expected)
+                )
+
+            with self.assertRaises(RuntimeError):
+                aggregate_parsed_cache(cache_path, errors_limit=0.1)
+
+    def test_build_log_report_uses_parsed_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(
+                config,
+                LOG_DIR="tests/data/logs",
+                REPORT_DIR=tmp_dir,
+                PARSED_CACHE_DIR=os.path.join(tmp_dir, "parsed"),
+            )
+            log_info = {
+                "file_date": "20180320",
+                "name": "nginx-access-ui.log-20180320.gz",
+            }
+            report_path = os.path.join(tmp_dir, "report-2018.03.20.html")
+
+            build_log_report(log_info, conf)
+            with open(report_path) as report_file:
+                parsed_report = report_file.read()
+            os.remove(report_path)
+
+            with self.assertLogs(level="INFO") as logs:
+                stats = build_log_report(log_info, conf)
+            self.assertTrue(any("Using parsed log" in line for line in logs.output))
+            self.assertTrue(stats["parsed_cache"])
+            self.assertEqual((stats["lines"], stats["bytes"]), (6, 0))
+            self.assertEqual(stats["bytes_per_sec"], 0)
+            with open(report_path) as report_file:
+                self.assertEqual(report_file.read(), parsed_report)
+
+    def test_build_log_report_saves_stats_sidecar(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(
+                config, LOG_DIR="tests/data/logs", REPORT_DIR=tmp_dir, SAVE_STATS=True
+            )
+            log_info = {
+                "file_date": "20180320",
+                "name": "nginx-access-ui.log-20180320.gz",
+            }
+
+            stats = build_log_report(log_info, conf)
+            with open(os.path.join(tmp_dir, "report-2018.03.20.stats.json")) as f:
+                saved_stats = json.load(f)
+
+        self.assertEqual(saved_stats, json.loads(json.dumps(stats)))
+        self.assertEqual(stats["lines"], 6)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(stats["distinct_urls"], 6)
+        self.assertEqual(
+            sorted(stats["stages"]), ["build_report", "collect", "render", "save"]
+        )
+        self.assertGreater(stats["stages"]["collect"]["wall"], 0)
+        self.assertEqual(sorted(stats["timings"]), ["aggregate", "decompress", "parse"])
+        self.assertEqual(stats["workers"], 1)
+
+    def test_build_log_report_times_parse_and_aggregate_apart(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180320")
+            with gzip.open("tests/data/logs/nginx-access-ui.log-20180320.gz") as f:
+                log_lines = f.read().rstrip(b"\n") + b"\n"
+            with open(log_path, "wb") as log_file:
+                log_file.write(log_lines * 1000)
+            log_info = {"file_date": "20180320", "name": os.path.basename(log_path)}
+
+            conf = dict(config, LOG_DIR=tmp_dir, REPORT_DIR=tmp_dir)
+            stats = build_log_report(log_info, conf)
+            self.assertEqual(sorted(stats["timings"]), ["aggregate", "parse"])
+            self.assertGreater(stats["timings"]["parse"], 0)
+            self.assertGreater(stats["timings"]["aggregate"], 0)
+            self.assertLess(
+                stats["timings"]["parse"] + stats["timings"]["aggregate"],
+                stats["stages"]["collect"]["wall"],
+            )
+
+            os.remove(os.path.join(tmp_dir, "report-2018.03.20.html"))
+            with self.assertLogs(level="INFO") as logs:
+                stats = build_log_report(log_info, dict(conf, WORKERS=2))
+            self.assertEqual(stats["lines"], 6000)
+            self.assertNotIn("parse", stats["timings"])
+            self.assertTrue(
+                any("2 worker processes aren't counted" in x for x in logs.output)
+            )
+
+    def test_get_complete_lines_end(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "log")
+            with open(log_path, "wb") as log_file:
+                log_file.write(b"first\nsecond\npartial")
+
+            self.assertEqual(get_complete_lines_end(log_path, 0, 21), 13)
+            self.assertEqual(get_complete_lines_end(log_path, 13, 21), 13)
+
+    def test_get_log_aggregate_incremental_parses_only_appended_lines(self):
+        gz_path = "tests/data/logs/nginx-access-ui.log-20180320.gz"
+        with gzip.open(gz_path) as gz_file:
+            lines = gz_file.read().splitlines(keepends=True)
+        settings = get_aggregate_settings(config)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180320")
+            with open(log_path, "wb") as log_file:
+                log_file.writelines(lines[:2])
+
+            aggregate, checkpoint = get_log_aggregate_incremental(
+                log_path, parse_log_record, None, 1, LogAggregate, settings, None
+            )
+            self.assertEqual(aggregate.total_records, 2)
+
+            with open(log_path, "ab") as log_file:
+                log_file.writelines(lines[2:4])
+                log_file.write(lines[4][:20])
+
+            aggregate, checkpoint = get_log_aggregate_incremental(
+                log_path,
+                parse_log_record,
+                None,
+                1,
+                LogAggregate,
+                settings,
+                checkpoint,
+            )
+            self.assertEqual(aggregate.total_records, 4)
+            self.assertEqual(checkpoint["offset"], sum(map(len, lines[:4])))
+
+            expected = build_report(aggregate_records(map(parse_log_record, lines[:4])))
+            self.assertReportsAlmostEqual(build_report(aggregate), expected)
+
+            # copytruncate keeps the inode, the log grows back past the offset
+            inode = os.stat(log_path).st_ino
+            with open(log_path, "wb") as log_file:
+                log_file.writelines(lines[4:5] + lines[:4])
+            self.assertEqual(os.stat(log_path).st_ino, inode)
+
+            aggregate, checkpoint = get_log_aggregate_incremental(
+                log_path,
+                parse_log_record,
+                None,
+                1,
+                LogAggregate,
+                settings,
+                checkpoint,
+            )
+            self.assertEqual(aggregate.total_records, 5)
+
+    def test_build_log_report_stats_count_only_appended_lines(self):
+        with gzip.open("tests/data/logs/nginx-access-ui.log-20180320.gz") as f:
+            lines = f.read().splitlines(keepends=True)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180320")
+            with open(log_path, "wb") as log_file:
+                log_file.writelines(lines[:4])
+            log_info = {"file_date": "20180320", "name": os.path.basename(log_path)}
+            conf = dict(
+                config,
+                LOG_DIR=tmp_dir,
+                REPORT_DIR=tmp_dir,
+                CHECKPOINT_DIR=os.path.join(tmp_dir, "checkpoints"),
+            )
+
+            stats = build_log_report(log_info, conf)
+            self.assertEqual(stats["lines"], 4)
+            self.assertEqual(stats["bytes"], sum(map(len, lines[:4])))
+
+            with open(log_path, "ab") as log_file:
+                log_file.writelines(lines[4:5])
+            stats = build_log_report(log_info, conf)
+
+        self.assertEqual(stats["lines"], 1)
+        self.assertEqual(stats["errors"], 0)
+        self.assertEqual(stats["bytes"], len(lines[4]))
+        self.assertFalse(stats["parsed_cache"])
+
     def test_get_latest_log_info(self):
         files_dir = "tests/data/logs"
         latest_log = get_latest_log_info(files_dir)
@@ -85,6 +856,337 @@ class TestLogAnalyzer(unittest.TestCase):
             {"file_date": "20180321", "name": "nginx-access-ui.log-20180321.gz"},
         )
 
+    def test_read_gzip_chunks_with_every_decompressor(self):
+        log_path = "tests/data/logs/nginx-access-ui.log-20180320.gz"
+        with gzip.open(log_path) as log_file:
+            data = log_file.read()
+
+        for decompressor in ("inline", "thread", "external"):
+            timings = {"decompress": 0.0, "parse": 0.0}
+            chunks = list(read_gzip_chunks(log_path, decompressor, timings, 100))
+            self.assertEqual(b"".join(chunks), data)
+            for chunk in chunks[:-1]:
+                self.assertTrue(chunk.endswith(b"\n"))
+            self.assertGreater(timings["decompress"], 0)
+
+    def test_read_gzip_chunks_thread_stops_when_reader_closes(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180320.gz")
+            with gzip.open(log_path, "wb") as log_file:
+                log_file.writelines(b"x" * 99 + b"\n" for _ in range(50))
+
+            chunks = read_gzip_chunks(log_path, "thread", None, 1000)
+            next(chunks)
+            # the thread fills the queue and hits EOF while nobody reads
+            time.sleep(0.3)
+
+            closing = threading.Thread(target=chunks.close, daemon=True)
+            closing.start()
+            closing.join(5)
+            self.assertFalse(closing.is_alive())
+
+    def test_read_gzip_chunks_raise_error_when_file_is_broken(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "nginx-access-ui.log-20180320.gz")
+            with open(log_path, "wb") as log_file:
+                log_file.write(b"not a gzip file")
+
+            for decompressor in ("inline", "thread", "external"):
+                with self.assertRaises(Exception):
+                    list(read_gzip_chunks(log_path, decompressor))
+
+    def test_get_log_files_info_sorted_by_date(self):
+        files_info = get_log_files_info("tests/data/logs")
+        self.assertEqual(
+            files_info,
+            [
+                {"file_date": "20180320", "name": "nginx-access-ui.log-20180320.gz"},
+                {"file_date": "20180321", "name": "nginx-access-ui.log-20180321.gz"},
+            ],
+        )
+
+    def test_get_log_files_info_with_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            logs_dir = os.path.join(tmp_dir, "logs")
+            os.mkdir(logs_dir)
+            index_path = os.path.join(tmp_dir, "index.json")
+            for name in (
+                "nginx-access-ui.log-20180322.gz",
+                "nginx-access-ui.log-20180320",
+                "nginx-access-ui.log-20180320.gz",
+                "nginx-access-ui.log-20180321.bz2",
+                "nginx-access-ui.log-2018032",
+            ):
+                open(os.path.join(logs_dir, name), "w").close()
+            os.mkdir(os.path.join(logs_dir, "nginx-access-ui.log-20180323"))
+
+            files_info = get_log_files_info(logs_dir, index_path)
+            self.assertEqual(
+                files_info,
+                [
+                    {"file_date": "20180320", "name": "nginx-access-ui.log-20180320"},
+                    {
+                        "file_date": "20180322",
+                        "name": "nginx-access-ui.log-20180322.gz",
+                    },
+                ],
+            )
+            self.assertTrue(os.path.isfile(index_path))
+            self.assertEqual(get_log_files_info(logs_dir), files_info)
+
+            # the index is used while the dir isn't changed
+            dir_stat = os.stat(logs_dir)
+            os.rename(
+                os.path.join(logs_dir, "nginx-access-ui.log-20180322.gz"),
+                os.path.join(logs_dir, "nginx-access-ui.log-20180324.gz"),
+            )
+            os.utime(logs_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+            self.assertEqual(get_log_files_info(logs_dir, index_path), files_info)
+
+            os.utime(logs_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns + 1))
+            self.assertEqual(
+                get_latest_log_info(logs_dir, index_path),
+                {"file_date": "20180324", "name": "nginx-access-ui.log-20180324.gz"},
+            )
+
+    def test_backfill_builds_missing_reports(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(
+                config,
+                LOG_DIR="tests/data/logs",
+                REPORT_DIR=tmp_dir,
+                BACKFILL_WORKERS=2,
+            )
+            with open(os.path.join(tmp_dir, "report-2018.03.20.html"), "w"):
+                pass
+
+            backfill(conf)
+
+            self.assertEqual(
+                sorted(os.listdir(tmp_dir)),
+                ["report-2018.03.20.html", "report-2018.03.21.html"],
+            )
+            self.assertEqual(
+                os.path.getsize(os.path.join(tmp_dir, "report-2018.03.20.html")), 0
+            )
+            with open(os.path.join(tmp_dir, "report-2018.03.21.html")) as report:
+                self.assertIn("/api/v2/banner/25019354", report.read())
+
+    def test_rollup_merges_saved_daily_aggregates(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(
+                config,
+                LOG_DIR="tests/data/logs",
+                REPORT_DIR=tmp_dir,
+                SAVE_AGGREGATES=True,
+                BACKFILL_WORKERS=1,
+            )
+            backfill(conf)
+            self.assertTrue(
+                os.path.isfile(os.path.join(tmp_dir, "aggregate-2018.03.21.json"))
+            )
+
+            aggregate = load_rollup_aggregate(tmp_dir, "2018.03.19", "2018.03.21")
+            expected = LogAggregate()
+            for name in sorted(os.listdir("tests/data/logs")):
+                log_path = os.path.join("tests/data/logs", name)
+                for href, request_time in get_log_records(log_path, parse_log_record):
+                    expected.add(href, request_time)
+            self.assertReportsAlmostEqual(
+                build_report(aggregate), build_report(expected)
+            )
+
+            report_path = rollup(conf, "2018.03.20", "2018.03.21")
+            self.assertEqual(
+                os.path.basename(report_path), "report-2018.03.20-2018.03.21.html"
+            )
+            self.assertIsNone(rollup(conf, "2018.04.01", "2018.04.02"))
+            with self.assertRaises(ValueError):
+                rollup(conf, "2018.03.21", "2018.03.20")
+
+    def test_render_template_streams_same_report(self):
+        records = get_log_records(
+            "tests/data/logs/nginx-access-ui.log-20180320.gz", parse_log_record
+        )
+        report_data = build_report(aggregate_records(records))
+        with open("templates/report.html") as template_file:
+            expected = Template(template_file.read()).safe_substitute(
+                table_json=json.dumps(report_data)
+            )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report.html")
+            render_template("templates", report_path, iter(report_data))
+            with open(report_path) as report_file:
+                self.assertEqual(report_file.read(), expected)
+            self.assertEqual(os.listdir(tmp_dir), ["report.html"])
+
+    def test_rolling_windows_drop_old_buckets(self):
+        windows = RollingWindows(LogAggregate, bucket_seconds=10)
+        windows.add("/old", 1.0, now=1000)
+        windows.add("/recent", 2.0, now=1830)
+        windows.add("/recent", 4.0, now=1895)
+        windows.add_error(now=1899)
+
+        snapshot = windows.snapshot(now=1899)
+        self.assertEqual(snapshot["1m"]["total_records"], 1)
+        self.assertEqual(snapshot["1m"]["errors"], 1)
+        self.assertEqual(snapshot["5m"]["urls"][0]["href"], "/recent")
+        self.assertEqual(snapshot["5m"]["urls"][0]["count"], 2)
+        self.assertEqual(snapshot["15m"]["total_records"], 3)
+
+        # the ring is reused, so stale buckets are replaced instead of growing
+        windows.add("/late", 1.0, now=2800)
+        self.assertEqual(len(windows.buckets), 90)
+        self.assertEqual(windows.snapshot(now=2800)["15m"]["total_records"], 1)
+
+    def test_follow_log_lines_across_rotation(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = os.path.join(tmp_dir, "access.log")
+            with open(log_path, "wb") as log_file:
+                log_file.write(b"before follow\n")
+
+            lines = follow_log_lines(log_path, sleep=lambda seconds: None)
+            self.assertIsNone(next(lines))
+
+            with open(log_path, "ab") as log_file:
+                log_file.write(b"first\nsec")
+            self.assertEqual(next(lines), b"first")
+            self.assertIsNone(next(lines))
+
+            with open(log_path, "ab") as log_file:
+                log_file.write(b"ond\nlast of old\n")
+            os.rename(log_path, log_path + ".1")
+            with open(log_path, "wb") as log_file:
+                log_file.write(b"new\n")
+
+            self.assertEqual(
+                [next(lines) for _ in range(4)],
+                [b"second", b"last of old", b"new", None],
+            )
+            lines.close()
+
+    def test_follow_dumps_rolling_snapshot(self):
+        log_path = "tests/data/logs/nginx-access-ui.log-20180320.gz"
+        with gzip.open(log_path) as log_file:
+            log_lines = log_file.read().splitlines()
+        # a line every 30 seconds, so only the last one is in 1m window
+        clock = iter(range(0, 30 * (len(log_lines) + 2), 30))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(config, REPORT_DIR=tmp_dir, FOLLOW_SNAPSHOT_INTERVAL=10)
+            snapshot_path = follow(
+                conf, lines=log_lines + [None], clock=lambda: next(clock)
+            )
+            with open(snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+
+        expected = aggregate_records(get_log_records(log_path, parse_log_record))
+        windows = snapshot["windows"]
+        self.assertEqual(windows["1m"]["total_records"], 1)
+        self.assertEqual(windows["5m"]["total_records"], expected.total_records)
+        self.assertEqual(
+            sorted(row["href"] for row in windows["5m"]["urls"]),
+            sorted(row["href"] for row in build_report(expected)),
+        )
+
+    def test_follow_when_requests_take_no_time(self):
+        with gzip.open("tests/data/logs/nginx-access-ui.log-20180320.gz") as f:
+            line = f.readline().rstrip(b"\n")
+        cached_line = line.rsplit(b" ", 1)[0] + b" 0.000"
+        clock = iter(range(0, 100, 5))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            conf = dict(config, REPORT_DIR=tmp_dir, FOLLOW_SNAPSHOT_INTERVAL=10)
+            snapshot_path = follow(
+                conf,
+                lines=[cached_line, None, None, line, None],
+                clock=lambda: next(clock),
+            )
+            with open(snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+
+        self.assertEqual(snapshot["windows"]["1m"]["total_records"], 2)
+
+        aggregate = GroupedLogAggregate([["status"]])
+        aggregate.add("/cached", 0.0, (200, 0))
+        (report_line,) = build_report(aggregate)
+        self.assertEqual(report_line["time_perc"], 0.0)
+        self.assertEqual(build_group_reports(aggregate)["status"][0]["time_perc"], 0)
+
+    def test_generated_log_is_parsed_and_deterministic(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_path = generate_log(tmp_dir, 2000, urls=50, error_rate=0.05, seed=1)
+            self.assertEqual(
+                os.path.basename(log_path), "nginx-access-ui.log-20170629.gz"
+            )
+            with open(log_path, "rb") as log_file:
+                first_log = log_file.read()
+            generate_log(tmp_dir, 2000, urls=50, error_rate=0.05, seed=1)
+            with open(log_path, "rb") as log_file:
+                self.assertEqual(log_file.read(), first_log)
+
+            counters = {}
+            aggregate = aggregate_records(
+                get_log_records(log_path, parse_log_record, counters=counters)
+            )
+
+        self.assertEqual(counters["records"] + counters["errors"], 2000)
+        self.assertAlmostEqual(counters["errors"] / 2000, 0.05, delta=0.02)
+        self.assertLessEqual(len(aggregate.urls), 50)
+
+    def test_save_paged_report(self):
+        records = get_log_records(
+            "tests/data/logs/nginx-access-ui.log-20180320.gz", parse_log_record
+        )
+        report_data = build_report(aggregate_records(records))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_path = os.path.join(tmp_dir, "report-2018.03.20.html")
+            data_dir = os.path.join(tmp_dir, "report-2018.03.20.data")
+            conf = dict(config, REPORT_FORMAT="paged", REPORT_PAGE_SIZE=4)
+            os.makedirs(data_dir)
+            open(os.path.join(data_dir, "page-00009.js"), "w").close()
+
+            save_report(conf, report_path, iter(report_data))
+
+            self.assertEqual(
+                sorted(os.listdir(data_dir)),
+                ["index.json", "page-00000.js", "page-00001.js"],
+            )
+            with open(os.path.join(data_dir, "index.json")) as index_file:
+                index = json.load(index_file)
+            self.assertEqual(
+                index,
+                {
+                    "rows": 6,
+                    "page_size": 4,
+                    "pages": 2,
+                    "columns": list(report_data[0]),
+                },
+            )
+            rows = []
+            for page in range(index["pages"]):
+                page_path = os.path.join(data_dir, "page-{:05d}.js".format(page))
+                with open(page_path) as page_file:
+                    script = page_file.read()
+                # reportPage(page, rows);
+                prefix, _, rows_json = script.partition(", ")
+                self.assertEqual(prefix, "reportPage({}".format(page))
+                self.assertTrue(rows_json.endswith(");\n"))
+                rows.extend(json.loads(rows_json[:-3]))
+            self.assertEqual(rows, report_data)
+
+            with open(report_path) as report_file:
+                report = report_file.read()
+            self.assertIn('"data_url": "report-2018.03.20.data"', report)
+            self.assertNotIn("$report_index", report)
+            self.assertIn("window.reportPage = ", report)
+            self.assertNotIn("fetch(", report)
+
+            with self.assertRaises(ValueError):
+                save_report(dict(config, REPORT_FORMAT="pdf"), report_path, [])
+
     def test_get_latest_log_empty_dir(self):
         files_dir = "other/dir"
         latest_log = get_latest_log_info(files_dir)